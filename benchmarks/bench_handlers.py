@@ -0,0 +1,113 @@
+"""
+Benchmarks every error handling path: api, web and failure handlers and the default dispatchers,
+with different number of blueprints, with and without ERROR_FORCE_CONTENT_TYPE and with large payloads.
+
+    $ python benchmarks/bench_handlers.py --output baseline.json
+    $ python benchmarks/bench_handlers.py --compare baseline.json
+"""
+import argparse
+import itertools
+import logging
+import sys
+
+from common import compare, measure, measure_alloc, report, save
+
+import flask
+from werkzeug.exceptions import NotFound
+
+from flask_errors_handler import ApiProblem, ErrorHandler
+
+BLUEPRINTS = (1, 50, 500)
+DISPATCHERS = ('default', 'subdomain', 'urlprefix')
+SERVER_NAME = 'bench.local'
+
+
+def create_app(blueprints, force_content_type, dispatcher=None):
+    """
+
+    :param blueprints: number of blueprints
+    :param force_content_type: value of ERROR_FORCE_CONTENT_TYPE
+    :param dispatcher: dispatcher name
+    :return: Flask app and ErrorHandler
+    """
+    app = flask.Flask(__name__)
+    app.config['SERVER_NAME'] = SERVER_NAME
+    app.config['ERROR_FORCE_CONTENT_TYPE'] = force_content_type
+    app.logger.setLevel(logging.CRITICAL)
+
+    handler = ErrorHandler()
+    handler.init_app(app, dispatcher=dispatcher)
+
+    for i in range(blueprints):
+        bp = flask.Blueprint(f"bp{i}", __name__, url_prefix=f"/bp{i}", subdomain=f"bp{i}")
+        handler.api_register(bp)
+        app.register_blueprint(bp)
+
+    return app, handler
+
+
+def scenarios(blueprints, force_content_type):
+    """
+    Yields name, app, request context arguments and function to benchmark
+
+    :param blueprints: number of blueprints
+    :param force_content_type: value of ERROR_FORCE_CONTENT_TYPE
+    """
+    suffix = f"[bp={blueprints},force={force_content_type}]"
+    last = f"bp{blueprints - 1}"
+    request = dict(path=f"/{last}/not-found", base_url=f"http://{last}.{SERVER_NAME}")
+    large = dict(errors=[dict(field=f"field{i}", message='invalid value' * 5) for i in range(1000)])
+
+    app, handler = create_app(blueprints, force_content_type)
+    yield f"api {suffix}", app, request, lambda: handler._api_handler(NotFound())
+    yield f"api large payload {suffix}", app, request, lambda: handler._api_handler(ApiProblem(response=large))
+    yield f"api errors stream {suffix}", app, request, lambda: sum(
+        len(c) for c in handler._api_handler(ApiProblem(errors=iter(large['errors']))).iter_encoded()
+    )
+    yield f"web {suffix}", app, request, lambda: handler._web_handler(NotFound())
+    yield f"failure {suffix}", app, request, lambda: handler._failure_handler(NameError('failure'))
+
+    for name in DISPATCHERS:
+        app, handler = create_app(blueprints, force_content_type, dispatcher=name)
+        dispatch = app.error_handler_spec[None][404][NotFound]
+        yield f"dispatcher {name} {suffix}", app, request, lambda d=dispatch: d(NotFound())
+
+
+def run(number, blueprints):
+    """
+
+    :param number: calls for each benchmark repetition
+    :param blueprints: list of number of blueprints
+    :return: dict of results by benchmark name
+    """
+    results = {}
+    for count, force in itertools.product(blueprints, (True, False)):
+        for name, app, request, func in scenarios(count, force):
+            with app.test_request_context(**request):
+                per_call = measure(func, number=number)
+                alloc = measure_alloc(func, number=min(number, 100))
+
+            report(name, per_call)
+            results[name] = dict(ops_per_sec=1 / per_call, us_per_op=per_call * 1e6, alloc_peak_bytes=alloc)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=1000, help='calls for each repetition')
+    parser.add_argument('--blueprints', type=int, nargs='+', default=BLUEPRINTS)
+    parser.add_argument('--output', help='save results as json baseline')
+    parser.add_argument('--compare', help='compare results against a json baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='max relative slowdown tolerated')
+    args = parser.parse_args()
+
+    results = run(args.number, args.blueprints)
+
+    if args.output:
+        save(results, args.output)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
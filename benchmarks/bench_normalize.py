@@ -0,0 +1,77 @@
+"""
+Compares the per-error cost of the registry normalizer against the chain of mixins
+and measures the cost of recording problems
+"""
+import itertools
+import logging
+
+from common import measure, report
+
+from flask import Flask
+from werkzeug import exceptions
+
+from flask_errors_handler import ApiProblem, DefaultNormalizer, ErrorHandler
+from flask_errors_handler.logs import ExceptionDump
+from flask_errors_handler.normalize import (
+    MethodNotAllowedMixin, NormalizerMixin, RegistryMixin, RequestedRangeNotSatisfiableMixin,
+    RequestRedirectMixin, RetryAfterMixin, UnauthorizedMixin
+)
+from flask_errors_handler.recorder import ProblemRecorder
+
+
+class ChainMixins(
+    MethodNotAllowedMixin,
+    RequestRedirectMixin,
+    UnauthorizedMixin,
+    RequestedRangeNotSatisfiableMixin,
+    RetryAfterMixin,
+):
+    """
+        Chain of mixins as it was before the registry
+    """
+
+
+class ChainNormalizer(NormalizerMixin, ChainMixins):
+    """
+        Normalizer as it was before the registry
+    """
+
+
+NORMALIZERS = (
+    ('mixins chain only', ChainMixins()),
+    ('registry only', RegistryMixin()),
+    ('mixins chain normalizer', ChainNormalizer()),
+    ('registry normalizer', DefaultNormalizer()),
+)
+
+
+ERRORS = {
+    'not found': lambda: exceptions.NotFound(),
+    'method not allowed': lambda: exceptions.MethodNotAllowed(valid_methods=['GET', 'POST']),
+    'too many requests': lambda: exceptions.TooManyRequests(retry_after=10),
+    'unhandled': lambda: NameError('unhandled'),
+}
+
+
+def main():
+    app = Flask(__name__)
+    ErrorHandler().init_app(app)
+    app.logger.setLevel(logging.CRITICAL)
+
+    with app.test_request_context():
+        for error, factory in ERRORS.items():
+            for name, normalizer in NORMALIZERS:
+                report(f"{name}: {error}", measure(lambda: normalizer.normalize(factory(), exc_class=ApiProblem)))
+
+        recorder = ProblemRecorder()
+        try:
+            raise NameError('unhandled')
+        except NameError as exc:
+            tb = ExceptionDump(exc)
+        problems = itertools.cycle((ApiProblem(), ApiProblem()))  # the same problem is recorded once
+        report("recorder: not found", measure(lambda: recorder.record(next(problems))))
+        report("recorder: unhandled", measure(lambda: recorder.record(next(problems), tb)))
+
+
+if __name__ == '__main__':
+    main()
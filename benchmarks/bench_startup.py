@@ -0,0 +1,89 @@
+"""
+Benchmarks app startup: creation of app and registration of error handlers on blueprints,
+with one handler for every werkzeug status code and with bulk registration.
+
+    $ python benchmarks/bench_startup.py --blueprints 100 500
+"""
+import argparse
+import logging
+import sys
+
+from common import compare, measure, report, save
+
+import flask
+
+from flask_errors_handler import ErrorHandler
+
+BLUEPRINTS = (1, 50, 500)
+
+
+def create_app(blueprints, bulk):
+    """
+
+    :param blueprints: number of blueprints
+    :param bulk: value of ERROR_REGISTER_BULK
+    :return: Flask app
+    """
+    app = flask.Flask(__name__)
+    app.config['ERROR_REGISTER_BULK'] = bulk
+    app.logger.setLevel(logging.CRITICAL)
+
+    handler = ErrorHandler()
+    handler.init_app(app)
+
+    for i in range(blueprints):
+        bp = flask.Blueprint(f"bp{i}", __name__, url_prefix=f"/bp{i}")
+        handler.api_register(bp)
+        app.register_blueprint(bp)
+
+    return app
+
+
+def spec_size(app):
+    """
+
+    :param app: Flask app
+    :return: number of error handlers registered
+    """
+    return sum(len(h) for codes in app.error_handler_spec.values() for h in codes.values())
+
+
+def run(number, blueprints):
+    """
+
+    :param number: startups for each benchmark repetition
+    :param blueprints: list of number of blueprints
+    :return: dict of results by benchmark name
+    """
+    results = {}
+    for count in blueprints:
+        for bulk in (False, True):
+            name = f"startup [bp={count},bulk={bulk}]"
+            per_call = measure(lambda: create_app(count, bulk), number=number, repeat=3)
+            handlers = spec_size(create_app(count, bulk))
+
+            report(name, per_call)
+            print(f"{'':<50} {handlers:>12,} handlers")
+            results[name] = dict(ops_per_sec=1 / per_call, us_per_op=per_call * 1e6, handlers=handlers)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=5, help='startups for each repetition')
+    parser.add_argument('--blueprints', type=int, nargs='+', default=BLUEPRINTS)
+    parser.add_argument('--output', help='save results as json baseline')
+    parser.add_argument('--compare', help='compare results against a json baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='max relative slowdown tolerated')
+    args = parser.parse_args()
+
+    results = run(args.number, args.blueprints)
+
+    if args.output:
+        save(results, args.output)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
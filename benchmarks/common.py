@@ -0,0 +1,97 @@
+"""
+Helpers shared by benchmark scripts, run them from the repository root, i.e.:
+
+    $ python benchmarks/bench_normalize.py
+"""
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(func, number=10000, repeat=5):
+    """
+
+    :param func: function without arguments to benchmark
+    :param number: calls for each repetition
+    :param repeat: repetitions, the best one is taken
+    :return: seconds per call
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def report(name, per_call):
+    """
+
+    :param name: benchmark name
+    :param per_call: seconds per call
+    """
+    print(f"{name:<50} {1 / per_call:>12,.0f} ops/s {per_call * 1e6:>10.2f} us")
+
+
+def measure_alloc(func, number=100):
+    """
+    Measures the peak of memory allocated by a single call, averaged over number calls
+
+    :param func: function without arguments to benchmark
+    :param number: calls to average
+    :return: bytes
+    """
+    func()  # warm up caches
+    total = 0
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            func()
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total / number
+
+
+def save(results, path):
+    """
+
+    :param results: dict of results by benchmark name
+    :param path: json file path
+    """
+    import flask
+
+    data = dict(
+        meta=dict(python=platform.python_version(), flask=getattr(flask, '__version__', None)),
+        results=results
+    )
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def compare(results, path, threshold=0.1):
+    """
+    Prints the difference of ops/sec against a baseline
+
+    :param results: dict of results by benchmark name
+    :param path: baseline json file path
+    :param threshold: max relative slowdown tolerated
+    :return: list of regressed benchmark names
+    """
+    with open(path) as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        delta = res['ops_per_sec'] / base['ops_per_sec'] - 1
+        flag = ''
+        if delta < -threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print(f"{name:<60} {delta:>+8.1%}{flag}")
+    return regressions
@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+
+        :param maxsize: max number of items, the least recently used are discarded
+        :param ttl: optional seconds after which items expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+
+        :param key:
+        :param default: returned on miss
+        :return: cached value
+        """
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+
+        :param key:
+        :param value:
+        """
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = value, expires
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all items and resets stats
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """
+
+        :return: dict with hits, misses, current size and max size
+        """
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data), maxsize=self.maxsize)
+
+
+def freeze(obj):
+    """
+    Builds a hashable representation of json like objects
+
+    :param obj: None, scalar, list, tuple or dict
+    :return: hashable object
+    :raise TypeError: if obj contains other types
+    """
+    if obj is None or isinstance(obj, str):
+        return obj
+    if isinstance(obj, (int, float)):
+        return type(obj), obj  # avoid True == 1 collisions
+    if isinstance(obj, Mapping):
+        return dict, tuple((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(i) for i in obj)
+    raise TypeError("unable to freeze object of type '{}'".format(type(obj).__name__))
@@ -1,8 +1,19 @@
+import re
+from contextvars import ContextVar
+
 import flask
 from flask import current_app as cap
 
+# blueprint resolved by dispatcher, request.blueprint is None for routing errors
+dispatched_blueprint = ContextVar('errors_handler_dispatched_blueprint', default=None)
+
 
 class ErrorDispatcher:
+    generation = 0  # incremented every time an error handler is registered
+
+    _handlers = None
+    _cache_key = None
+
     @staticmethod
     def default(exc):
         """
@@ -10,9 +21,106 @@ class ErrorDispatcher:
         :param exc:
         :return:
         """
-        return flask.render_template_string(
-            exc.default_html_template, exc=exc
-        ), exc.code
+        handler = cap.extensions.get('errors_handler')
+        if handler is None:  # pragma: no cover
+            return flask.render_template_string(exc.default_html_template, exc=exc), exc.code
+        return handler.render_default(exc), exc.code
+
+    @staticmethod
+    def invalidate():
+        """
+        Invalidates the indexes and the resolved handlers of all dispatchers
+        """
+        ErrorDispatcher.generation += 1
+
+    def refresh(self, app):
+        """
+        Called when registered blueprints or error handlers changed,
+        child class must call super().refresh() in order to clear resolved handlers
+
+        :param app: Flask instance
+        """
+        self._handlers = {}
+
+    def ensure_fresh(self):
+        """
+        Refreshes dispatcher the first time or after handlers or blueprints changed
+        """
+        key = (ErrorDispatcher.generation, len(cap.blueprints))
+        if self._cache_key != key:
+            self.refresh(cap)
+            self._cache_key = key
+
+    def get_handler(self, bp_name, exc):
+        """
+        Resolves the handler registered on blueprint for the exception,
+        resolutions are cached by blueprint, code and exception type
+
+        :param bp_name: registered name of blueprint
+        :param exc: exception instance
+        :return: error handler or None
+        """
+        key = (bp_name, exc.code, type(exc))
+        try:
+            return self._handlers[key]
+        except KeyError:
+            pass
+
+        handler = None
+        spec = cap.error_handler_spec.get(bp_name, {})
+        handlers = spec.get(exc.code) or {}
+        for cls in type(exc).__mro__:
+            if cls in handlers:
+                handler = handlers[cls]
+                break
+        else:
+            for handler in handlers.values():
+                break
+
+        if handler is None:
+            # handlers registered by class, i.e. HTTPException in bulk mode
+            handlers = spec.get(None) or {}
+            for cls in type(exc).__mro__:
+                if cls is Exception:
+                    break
+                if cls in handlers:
+                    handler = handlers[cls]
+                    break
+
+        self._handlers[key] = handler
+        return handler
+
+    def dispatch_to(self, bp_names, exc):
+        """
+
+        :param bp_names: candidate blueprints in order of priority
+        :param exc: exception instance
+        :return: response of first blueprint handler found or None
+        """
+        for bp_name in bp_names:
+            handler = self.get_handler(bp_name, exc)
+            if handler is not None:
+                token = dispatched_blueprint.set(bp_name)
+                try:
+                    return handler(exc)
+                finally:
+                    dispatched_blueprint.reset(token)
+        return None
+
+    def dispatch_request_blueprint(self, exc):
+        """
+        Flask looks up app handlers registered by code before blueprint handlers registered by class,
+        so the ones of blueprint of request, i.e. HTTPException in bulk mode, are tried here
+
+        :param exc: exception instance
+        :return: response of blueprint handler or None
+        """
+        bp_name = flask.request.blueprint
+        if bp_name is None:
+            return None
+
+        self.ensure_fresh()
+        return self.dispatch_to((bp_name,), exc)
 
     def dispatch(self, exc, **kwargs):
         """
@@ -32,42 +140,154 @@ class DefaultDispatcher(ErrorDispatcher):
 
 
 class SubdomainDispatcher(ErrorDispatcher):
+    cache_size = 1024
+
+    def __init__(self):
+        self._index = {}
+        self._patterns = ()
+        self._resolved = {}
+        self._len_domain = 0
+
+    @staticmethod
+    def compile_pattern(subdomain):
+        """
+        Compiles a subdomain with variable parts, like: '<tenant>.api'
+
+        :param subdomain: blueprint subdomain
+        :return: compiled regex
+        """
+        parts = re.split(r'(<[^>]+>)', subdomain)
+        return re.compile(''.join(
+            r'[^.]+' if p.startswith('<') else re.escape(p) for p in parts
+        ))
+
+    def refresh(self, app):
+        """
+        Maps every static subdomain to its blueprints
+        and compiles the subdomains with variable parts,
+        when 2 blueprints share the same subdomain the first registered wins
+
+        :param app: Flask instance
+        """
+        super().refresh(app)
+        index, patterns = {}, []
+        for bp_name, bp in app.blueprints.items():
+            if bp.subdomain and '<' in bp.subdomain:
+                patterns.append((bp.subdomain, bp_name))
+            else:
+                index.setdefault(bp.subdomain, []).append(bp_name)
+
+        # most specific patterns first, i.e. with more static characters
+        patterns.sort(key=lambda p: len(re.sub(r'<[^>]+>', '', p[0])), reverse=True)
+
+        self._index = index
+        self._patterns = tuple((self.compile_pattern(s), n) for s, n in patterns)
+        self._resolved = {}
+        self._len_domain = len(app.config.get('SERVER_NAME') or '')
+
+        if not self._len_domain:  # pragma: no cover
+            app.logger.warning("You must set 'SERVER_NAME' in order to use %s", self.__class__)
+
+    def resolve(self, subdomain):
+        """
+
+        :param subdomain: subdomain of request
+        :return: candidate blueprints in order of priority
+        """
+        try:
+            return self._resolved[subdomain]
+        except KeyError:
+            pass
+
+        bp_names = list(self._index.get(subdomain) or ())
+        for pattern, bp_name in self._patterns:
+            if pattern.fullmatch(subdomain or ''):
+                bp_names.append(bp_name)
+
+        if len(self._resolved) >= self.cache_size:
+            self._resolved = {}
+        self._resolved[subdomain] = bp_names = tuple(bp_names)
+        return bp_names
+
     def dispatch(self, exc, **kwargs):
         """
 
         :param exc:
         :return:
         """
-        len_domain = len(cap.config.get('SERVER_NAME') or '')
-        if len_domain > 0:
-            subdomain = flask.request.host[:-len_domain].rstrip('.') or None
-            for bp_name, bp in cap.blueprints.items():
-                if subdomain == bp.subdomain:
-                    handler = cap.error_handler_spec.get(bp_name, {}).get(exc.code)
-                    for k, v in (handler or {}).items():
-                        return v(exc)
-        else:  # pragma: no cover
-            cap.logger.warning("You must set 'SERVER_NAME' in order to use %s", self.__class__)
+        self.ensure_fresh()
+
+        if self._len_domain > 0:
+            subdomain = flask.request.host[:-self._len_domain].rstrip('.') or None
+            response = self.dispatch_to(self.resolve(subdomain), exc)
+            if response is not None:
+                return response
 
         return self.default(exc)  # pragma: no cover
 
 
 class URLPrefixDispatcher(ErrorDispatcher):
+    def __init__(self):
+        self._index = {}
+
+    @staticmethod
+    def blueprint_prefixes(name, bp, prefix):
+        """
+        Yields the url prefix of the blueprint and of its nested blueprints
+
+        :param name: registered name of blueprint
+        :param bp: Blueprint instance
+        :param prefix: url prefix of blueprint
+        """
+        yield name, prefix
+
+        for child, options in getattr(bp, '_blueprints', ()):
+            child_prefix = options.get('url_prefix') or child.url_prefix
+            if prefix and child_prefix:
+                child_prefix = "{}/{}".format(prefix.rstrip('/'), child_prefix.lstrip('/'))
+            child_name = "{}.{}".format(name, options.get('name', child.name))
+            yield from URLPrefixDispatcher.blueprint_prefixes(child_name, child, child_prefix or prefix)
+
+    def refresh(self, app):
+        """
+        Maps every url prefix to its blueprints,
+        when 2 blueprints share the same prefix the first registered wins
+
+        :param app: Flask instance
+        """
+        super().refresh(app)
+        index = {}
+        for bp_name, bp in app.blueprints.items():
+            if '.' in bp_name:
+                continue  # nested blueprints are reached from their parent
+
+            for name, prefix in self.blueprint_prefixes(bp_name, bp, bp.url_prefix):
+                if not prefix:
+                    app.logger.warning("You must set 'url_prefix' when instantiate Blueprint: '%s'", name)
+                    continue
+
+                index.setdefault(prefix.rstrip('/'), []).append(name)
+
+        self._index = index
+
     def dispatch(self, exc, **kwargs):
         """
 
         :param exc:
         :return:
         """
-        for bp_name, bp in cap.blueprints.items():
-            if not bp.url_prefix:
-                cap.logger.warning("You must set 'url_prefix' when instantiate Blueprint: '%s'", bp_name)
-                continue
+        self.ensure_fresh()
 
-            if flask.request.path.startswith(bp.url_prefix):
-                handler = cap.error_handler_spec.get(bp_name, {}).get(exc.code)
-                for k, v in (handler or {}).items():
-                    return v(exc)
+        path = flask.request.path.rstrip('/')
+        while True:
+            bp_names = self._index.get(path)
+            if bp_names:
+                response = self.dispatch_to(bp_names, exc)
+                if response is not None:
+                    return response
+            if not path:
+                break
+            path = path.rpartition('/')[0]
 
         return self.default(exc)  # pragma: no cover
 
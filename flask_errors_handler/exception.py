@@ -1,4 +1,117 @@
+from functools import lru_cache
+from types import MappingProxyType
+
 from werkzeug.exceptions import InternalServerError
+from werkzeug.http import HTTP_STATUS_CODES
+
+MEMBERS = ('type', 'instance', 'detail', 'title', 'status', 'response', 'errors')
+
+
+@lru_cache(maxsize=512)
+def format_type(problem_type, code):
+    """
+
+    :param problem_type: type of problem, it may contain the placeholder {code}
+    :param code: http status code
+    :return: formatted type
+    """
+    return problem_type.format(code=code)
+
+
+def extension_members(cls):
+    """
+    Collects extension members declared by class and by its parents,
+    members without default value are set to None on class
+
+    :param cls: ApiProblem subclass
+    :return: tuple of names
+    """
+    names = []
+    for klass in reversed(cls.__mro__):
+        for name in klass.__dict__.get('extensions', ()):
+            # attributes of ApiProblem and HTTPException, i.e. code or name, can not be extensions
+            if not name.isidentifier() or name.startswith('_') or name in MEMBERS or hasattr(ApiProblem, name):
+                raise ValueError("invalid extension member of {}: '{}'".format(cls.__name__, name))
+            if name not in names:
+                names.append(name)
+
+    for name in names:
+        if not hasattr(cls, name):
+            setattr(cls, name, None)
+    return tuple(names)
+
+
+def overrides_serialization(cls):
+    """
+    Getters, title, to_dict and prepare_response overridden by class may read per request data
+
+    :param cls: ApiProblem subclass
+    :return: True if any of them is overridden
+    """
+    for attr in ('get_type', 'get_instance', 'get_detail', 'name', 'prepare_response'):
+        if getattr(cls, attr) is not getattr(ApiProblem, attr):
+            return True
+    return not getattr(cls.to_dict, 'generated', False)
+
+
+def compile_to_dict(cls):
+    """
+    Generates the function that converts problems of class into dict, with members in order:
+    type, instance, detail, title, status, response, extensions not None and errors if not None.
+    Overridden getters are called, otherwise attributes are read directly
+    and type is pre-formatted for every status code
+
+    :param cls: ApiProblem subclass
+    :return: function
+    """
+    names = cls.extension_members
+
+    def overridden(attr):
+        return getattr(cls, attr) is not getattr(ApiProblem, attr, None)
+
+    if overridden('get_type'):
+        type_expr = "self.get_type()"
+    else:
+        type_expr = "(_types.get(code) if t is _type else None) or _format_type(t, code)"
+
+    lines = [
+        "def to_dict(self):",
+        "    code = self.code",
+        "    t = self.type",
+        "    data = {",
+        "        'type': {},".format(type_expr),
+        "        'instance': {},".format("self.get_instance()" if overridden('get_instance') else "self.instance"),
+        "        'detail': {},".format("self.get_detail()" if overridden('get_detail') else "self.description"),
+        "        'title': {},".format("self.name" if overridden('name') else "_titles.get(code, 'Unknown Error')"),
+        "        'status': code,",
+        "        'response': self.response,",
+        "    }",
+    ]
+    for name in names:
+        lines += [
+            "    v = self.{}".format(name),
+            "    if v is not None:",
+            "        data['{}'] = v".format(name),
+        ]
+    lines += [
+        "    if self.errors is not None:",
+        "        data['errors'] = self.errors",
+        "    return data",
+    ]
+
+    try:
+        types = {c: cls.type.format(code=c) for c in HTTP_STATUS_CODES}
+    except (AttributeError, IndexError, KeyError, ValueError):
+        types = {}  # errors are raised when problems are serialized
+
+    namespace = dict(_type=cls.type, _types=types, _titles=HTTP_STATUS_CODES, _format_type=format_type)
+    exec('\n'.join(lines), namespace)
+
+    to_dict = namespace['to_dict']
+    to_dict.generated = True
+    to_dict.__qualname__ = "{}.to_dict".format(cls.__qualname__)
+    to_dict.__doc__ = "Generated by compile_to_dict, extension members: {}".format(', '.join(names) or '-')
+    return to_dict
 
 
 class ApiProblem(InternalServerError):
@@ -54,11 +167,16 @@ class ApiProblem(InternalServerError):
     The "detail" member, if present, ought to focus on helping the client
     correct the problem, rather than giving debugging information.
     """
-    headers = {}
+    headers = MappingProxyType({})  # default of class, instances own a copy merged with their headers
     response = None
+    errors = None  # multi problem extension, items may come from a generator
+    cacheable = False  # True if the problem does not carry per request data
+    custom_serialization = False  # True if class overrides getters or serialization, set when class is defined
     ct_id = 'problem'
     instance = 'about:blank'
     type = 'https://httpstatuses.com/{code}'
+    extensions = ()  # names of extension members, subclasses declare their own, i.e. ('balance', 'accounts')
+    extension_members = ()  # extensions of class and of its parents, set when class is defined
 
     default_html_template = '''
 <html>
@@ -80,38 +198,55 @@ class ApiProblem(InternalServerError):
         :param response:
 
         :param data:
+        :param errors: optional iterable of problems, i.e. one for each invalid field
+        :param kwargs: extension members declared by class
         """
         super().__init__(description, response)
 
-        self.type = kwargs.get('type', self.type)
-        self.instance = kwargs.get('instance', self.instance)
+        # type and instance are read from class unless overridden
+        if 'type' in kwargs:
+            self.type = kwargs['type']
+        if 'instance' in kwargs:
+            self.instance = kwargs['instance']
+
+        # every instance owns a copy, so class defaults are never changed through it
+        self.headers = {**type(self).headers, **(kwargs.get('headers') or {})}
+        if kwargs.get('errors') is not None:
+            self.errors = kwargs['errors']
 
-        h = kwargs.get('headers', {})
+        for name in self.extension_members:
+            if name in kwargs:
+                setattr(self, name, kwargs[name])
 
-        try:
-            self.headers.update(**h)
-        except AttributeError:  # pragma: no cover
-            self.headers = h
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.extension_members = extension_members(cls)
+        # to_dict defined by hand are kept
+        if getattr(cls.to_dict, 'generated', False):
+            cls.to_dict = compile_to_dict(cls)
+        cls.custom_serialization = overrides_serialization(cls)
+
+    def update_headers(self, headers):
+        """
+        Copy on write of headers, so they are never shared between instances
+
+        :param headers: dict of headers
+        """
+        self.headers = {**self.headers, **headers}
 
     def prepare_response(self):
         """
 
+        :return: problem dict, status code and headers dict
         """
-        return dict(
-            type=self.get_type(),
-            instance=self.get_instance(),
-            detail=self.get_detail(),
-            title=self.name,
-            status=self.code,
-            response=self.response
-        ), self.code, self.headers
+        return self.to_dict(), self.code, dict(self.headers)
 
     def get_type(self):
         """
 
         :return:
         """
-        return self.type.format(code=self.code)
+        return format_type(self.type, self.code)
 
     def get_instance(self):
         """
@@ -126,3 +261,6 @@ class ApiProblem(InternalServerError):
         :return:
         """
         return self.description
+
+
+ApiProblem.to_dict = compile_to_dict(ApiProblem)
@@ -1,16 +1,58 @@
+import hashlib
 from functools import wraps
 
 import flask
 from flask import current_app as cap
 from jinja2 import TemplateError
-from werkzeug.exceptions import default_exceptions
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException, default_exceptions
+from werkzeug.http import parse_accept_header
+from werkzeug.utils import import_string
 
-from .dispatchers import DEFAULT_DISPATCHERS, ErrorDispatcher
+from .cache import LRUCache, freeze
+from .dispatchers import DEFAULT_DISPATCHERS, ErrorDispatcher, dispatched_blueprint
 from .exception import ApiProblem
+from .metrics import MetricsRegistry, stage, trace
 from .normalize import BaseNormalize, DefaultNormalizer
+from .recorder import recorder_blueprint
+from .serializers import JSON_ENCODERS, MEDIA_TYPES, fallback_json, problem_json, problem_xml
+from .settings import AppStates, Settings
+from .shared import counters_command
+from .signals import error_storm_ended, error_storm_started, send
+from .storm import StormDetector
+
+
+class HandlerState:
+    __slots__ = (
+        'settings', 'json_encoder', 'templates', 'content_types', 'offers', 'negotiated', 'negotiable',
+        'response_cache', 'page_cache', 'page_cache_key', 'metrics', 'storm', 'storm_bodies',
+        'cache_policies', 'etags',
+    )
+
+    def __init__(self):
+        """
+            Settings, caches and collectors of ErrorHandler for a Flask app
+        """
+        self.settings = None
+        self.json_encoder = None
+        self.templates = {}
+        self.content_types = {}
+        self.offers = {}
+        self.negotiated = {}
+        self.negotiable = False
+        self.response_cache = None
+        self.page_cache = None
+        self.page_cache_key = None
+        self.metrics = None
+        self.storm = None
+        self.storm_bodies = {}
+        self.cache_policies = {}
+        self.etags = None
 
 
 class ErrorHandler:
+    negotiation_cache_size = 1024
+
     def __init__(self, app=None, **kwargs):
         """
 
@@ -19,12 +61,15 @@ class ErrorHandler:
         self._response = kwargs.get('response')
         self._exc_class = kwargs.get('exc_class')
         self._normalizer = kwargs.get('normalizer')
+        self._json_encoder = kwargs.get('json_encoder')
+        self._bulk = False
+        self._states = AppStates()
 
         if app is not None:
             self.init_app(app, **kwargs)  # pragma: no cover
 
     def init_app(self, app, response=None, exc_class=None,
-                 dispatcher=None, handler=None, normalizer=None):
+                 dispatcher=None, handler=None, normalizer=None, json_encoder=None):
         """
 
         :param app: Flask instance
@@ -33,6 +78,7 @@ class ErrorHandler:
         :param dispatcher: ErrorDispatcher instance or default configured string name
         :param handler: app error handler one of (api, web)
         :param normalizer: normalize exceptions class
+        :param json_encoder: function that returns json as bytes or string, or default encoder name
         """
         self._exc_class = exc_class or self._exc_class or ApiProblem
         self._normalizer = normalizer or self._normalizer or DefaultNormalizer()
@@ -41,7 +87,26 @@ class ErrorHandler:
         assert issubclass(self._exc_class, ApiProblem)
         assert isinstance(self._normalizer, BaseNormalize)
 
+        self._json_encoder = json_encoder or self._json_encoder
+
         self.set_default_config(app)
+        self._bulk = app.config['ERROR_REGISTER_BULK']
+        self._normalizer.init_app(app)
+
+        state = HandlerState()
+        state.json_encoder = self.load_json_encoder(self._json_encoder or app.config['ERROR_JSON_ENCODER'])
+        cache_size = app.config['ERROR_RESPONSE_CACHE']
+        state.response_cache = LRUCache(cache_size) if cache_size else None
+        self._states.set(app, state)
+
+        self.compile_templates(app)
+        self.reload_settings(app)
+        self.init_page_cache(app)
+        self.init_cache_policies(app)
+        self.init_metrics(app)
+        self.init_storm(app)
+        self.init_recorder(app)
+        self.init_counters(app)
 
         if not hasattr(app, 'extensions'):
             app.extensions = dict()  # pragma: no cover
@@ -72,6 +137,456 @@ class ErrorHandler:
         app.config.setdefault('ERROR_CONTENT_TYPES', ('json', 'xml'))
         app.config.setdefault('ERROR_DISPATCHER', None)
         app.config.setdefault('ERROR_HANDLER', None)
+        app.config.setdefault('ERROR_REGISTER_BULK', False)
+        app.config.setdefault('ERROR_RESPONSE_CACHE', 0)
+        app.config.setdefault('ERROR_JSON_ENCODER', 'flask')
+        app.config.setdefault('ERROR_TRACEBACK_LIMIT', 30)
+        app.config.setdefault('ERROR_LOG_SAMPLING_WINDOW', 0)
+        app.config.setdefault('ERROR_LOG_SAMPLING_MAX', 1000)
+        app.config.setdefault('ERROR_LOG_QUEUE', False)
+        app.config.setdefault('ERROR_LOG_QUEUE_SIZE', 10000)
+        app.config.setdefault('ERROR_LOG_HANDLER', None)
+        app.config.setdefault('ERROR_LOG_FILE', None)
+        app.config.setdefault('ERROR_LOG_FILE_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('ERROR_LOG_FILE_BACKUPS', 5)
+        app.config.setdefault('ERROR_METRICS', False)
+        app.config.setdefault('ERROR_METRICS_ENDPOINT', None)
+        app.config.setdefault('ERROR_STORM_THRESHOLD', 0)
+        app.config.setdefault('ERROR_STORM_WINDOW', 10)
+        app.config.setdefault('ERROR_STORM_RECOVERY', None)
+        app.config.setdefault('ERROR_PAGE_CACHE', 0)
+        app.config.setdefault('ERROR_PAGE_CACHE_TTL', 300)
+        app.config.setdefault('ERROR_PAGE_CACHE_KEY', None)
+        app.config.setdefault('ERROR_RECORDER_SIZE', 0)
+        app.config.setdefault('ERROR_RECORDER_TRACEBACK', 2000)
+        app.config.setdefault('ERROR_RECORDER_ENDPOINT', None)
+        app.config.setdefault('ERROR_RECORDER_SQLITE', None)
+        app.config.setdefault('ERROR_SHARED_COUNTERS', None)
+        app.config.setdefault('ERROR_SHARED_COUNTERS_SLOTS', 4096)
+        app.config.setdefault('ERROR_CACHE_POLICIES', {})
+        app.config.setdefault('ERROR_XML_ENABLED', False)
+
+    @property
+    def metrics(self):
+        """
+
+        :return: MetricsRegistry instance of current app or None if disabled
+        """
+        return self._states.current().metrics
+
+    def init_metrics(self, app):
+        """
+        Creates the metrics registry and registers the prometheus endpoint if configured
+
+        :param app: Flask instance
+        """
+        state = self._states.get(app)
+        if not app.config['ERROR_METRICS']:
+            state.metrics = None
+            return
+
+        registry = state.metrics = MetricsRegistry()
+        endpoint = app.config['ERROR_METRICS_ENDPOINT']
+        if endpoint:
+            def metrics_view():
+                return flask.Response(
+                    registry.to_prometheus(),
+                    mimetype='text/plain; version=0.0.4'
+                )
+
+            if 'errors_handler_metrics' in app.view_functions:
+                app.view_functions['errors_handler_metrics'] = metrics_view
+            else:
+                app.add_url_rule(endpoint, 'errors_handler_metrics', metrics_view)
+
+    @property
+    def recorder(self):
+        """
+
+        :return: ProblemRecorder instance or None if disabled
+        """
+        return getattr(self._normalizer, 'recorder', None)
+
+    @staticmethod
+    def init_recorder(app):
+        """
+        Registers the blueprint of recorded problems if configured
+
+        :param app: Flask instance
+        """
+        endpoint = app.config['ERROR_RECORDER_ENDPOINT']
+        if endpoint:
+            bp = recorder_blueprint(endpoint)
+            if bp.name not in app.blueprints:
+                app.register_blueprint(bp)
+
+    @property
+    def counters(self):
+        """
+
+        :return: SharedCounters instance or None if disabled
+        """
+        return getattr(self._normalizer, 'counters', None)
+
+    @staticmethod
+    def init_counters(app):
+        """
+        Adds the cli command that prints shared counters if enabled
+
+        :param app: Flask instance
+        """
+        if app.config['ERROR_SHARED_COUNTERS']:
+            app.cli.add_command(counters_command)
+
+    @property
+    def storm(self):
+        """
+
+        :return: StormDetector instance of current app or None if disabled
+        """
+        return self._states.current().storm
+
+    def init_storm(self, app):
+        """
+        Creates the detector of error storms and counts server errors of every response
+
+        :param app: Flask instance
+        """
+        state = self._states.get(app)
+        state.storm_bodies = {}
+        threshold = app.config['ERROR_STORM_THRESHOLD']
+        if not threshold:
+            state.storm = None
+            return
+
+        state.storm = StormDetector(
+            threshold,
+            app.config['ERROR_STORM_WINDOW'],
+            app.config['ERROR_STORM_RECOVERY'],
+            callback=self._storm_changed
+        )
+        if self._count_server_errors not in app.after_request_funcs.get(None, ()):
+            app.after_request(self._count_server_errors)
+
+    def _count_server_errors(self, response):
+        """
+
+        :param response: Flask response
+        :return: the same response
+        """
+        if response.status_code >= 500:
+            storm = self._states.current().storm
+            if storm is not None:
+                storm.hit()
+        return response
+
+    @staticmethod
+    def _storm_changed(active, rate):
+        """
+
+        :param active: True if storm started
+        :param rate: number of server errors in window
+        """
+        app = cap._get_current_object()
+        if active:
+            app.logger.warning("error storm started: %d server errors, serving minimal responses", rate)
+            send(error_storm_started, app, rate=rate)
+        else:
+            app.logger.warning("error storm ended: %d server errors", rate)
+            send(error_storm_ended, app, rate=rate)
+
+    def _in_storm(self, ex):
+        """
+
+        :param ex: Exception instance
+        :return: True if storm is active and exception is a server error
+        """
+        storm = self._states.current().storm
+        if storm is None or not storm.check():
+            return False
+        return not isinstance(ex, HTTPException) or (ex.code or 500) >= 500
+
+    def _storm_response(self, ex, kind, fmt):
+        """
+        Serves a prebuilt minimal body with headers of problem. The exception is normalized,
+        so it is still logged, recorded and counted, but its traceback is not formatted
+
+        :param ex: Exception instance
+        :param kind: kind of handler: api, web or failure
+        :param fmt: one of: json, xml, html
+        :return: Flask response
+        """
+        state = self._states.current()
+        with trace(state.metrics, kind, ex) as t:
+            with stage('normalize'):
+                ex = t.problem = self._normalizer.normalize(ex, self._exc_class, minimal=True)
+
+            code = ex.code or 500
+            try:
+                body, mimetype = state.storm_bodies[(code, fmt)]
+            except KeyError:
+                problem = self._exc_class(state.settings.default_msg)
+                problem.code = code
+                if fmt == 'html':
+                    body, mimetype = self.render_default(problem), 'text/html'
+                else:
+                    r, _, _ = problem.prepare_response()
+                    if fmt == 'xml':
+                        body = ''.join(problem_xml(r))
+                    else:
+                        body = self._encode_json(r)
+                    mimetype = 'application/{}+{}'.format(problem.ct_id, fmt)
+                state.storm_bodies[(code, fmt)] = body, mimetype
+
+            headers = {k: v for k, v in ex.headers.items() if k.lower() != 'content-type'}
+            resp = flask.Response(body, status=code, headers=headers, mimetype=mimetype)
+            if kind == 'web' or (kind == 'api' and state.negotiable):
+                resp.vary.add('Accept')
+            return resp
+
+    def reload_settings(self, app):
+        """
+        Takes a snapshot of configuration used while handling errors,
+        must be called if configuration changes after init_app
+
+        :param app: Flask instance
+        """
+        state = self._states.get(app)
+        state.settings = Settings.from_config(app.config)
+        state.content_types = {}
+        self._normalizer.reload_settings(app)
+        self.init_negotiation(app)
+
+    def init_negotiation(self, app):
+        """
+        Builds the media types offered to clients from ERROR_CONTENT_TYPES,
+        xml only if ERROR_XML_ENABLED. Json is offered first, so it wins ties, i.e. */*
+
+        :param app: Flask instance
+        """
+        ct_id = self._exc_class.ct_id
+        offered = ('json', 'xml') if app.config['ERROR_XML_ENABLED'] else ('json',)
+        formats = [f for f in offered if f in app.config['ERROR_CONTENT_TYPES']] or ['json']
+        api = tuple((m.format(ct_id=ct_id), f) for f in formats for m in MEDIA_TYPES[f])
+        web = tuple((m, 'html') for m in MEDIA_TYPES['html']) + api
+
+        state = self._states.get(app)
+        state.offers = {False: api, True: web}
+        state.negotiated = {}
+        state.negotiable = len(formats) > 1
+
+    def negotiate(self, web=False):
+        """
+        Finds the best format for the Accept header of request,
+        results are cached by Accept header
+
+        :param web: if True html is offered and preferred
+        :return: one of: json, xml, html
+        """
+        state = self._states.current()
+        accept = flask.request.headers.get('Accept', '')
+        try:
+            return state.negotiated[(accept, web)]
+        except KeyError:
+            pass
+
+        offers = state.offers[web]
+        best = parse_accept_header(accept, MIMEAccept).best_match([m for m, _ in offers])
+        fmt = dict(offers).get(best, offers[0][1])
+
+        if len(state.negotiated) >= self.negotiation_cache_size:
+            state.negotiated = {}
+        state.negotiated[(accept, web)] = fmt
+        return fmt
+
+    def compile_templates(self, app):
+        """
+        Compiles default templates of all ApiProblem classes and loads ERROR_PAGE
+        so that the first error served does not pay the jinja compilation
+
+        :param app: Flask instance
+        """
+        templates = self._states.get(app).templates = {}
+        classes = [ApiProblem, self._exc_class]
+        while classes:
+            exc_class = classes.pop()
+            classes.extend(exc_class.__subclasses__())
+            source = exc_class.default_html_template
+            if source not in templates:
+                templates[source] = app.jinja_env.from_string(source)
+
+        page = app.config['ERROR_PAGE']
+        if page:
+            try:
+                app.jinja_env.get_template(page)
+            except TemplateError:
+                app.logger.debug("unable to preload error page: '%s'", page)
+
+    def init_page_cache(self, app):
+        """
+        Creates the cache of rendered ERROR_PAGE if enabled
+
+        :param app: Flask instance
+        """
+        state = self._states.get(app)
+        cache_size = app.config['ERROR_PAGE_CACHE']
+        state.page_cache = LRUCache(cache_size, ttl=app.config['ERROR_PAGE_CACHE_TTL']) if cache_size else None
+
+        key_func = app.config['ERROR_PAGE_CACHE_KEY']
+        state.page_cache_key = import_string(key_func) if isinstance(key_func, str) else key_func
+
+    def page_cache_stats(self):
+        """
+
+        :return: stats of rendered ERROR_PAGE cache of current app or None if disabled
+        """
+        page_cache = self._states.current().page_cache
+        if page_cache is not None:
+            return page_cache.stats()
+        return None
+
+    def init_cache_policies(self, app):
+        """
+        Compiles Cache-Control values of ERROR_CACHE_POLICIES: keys are status code or tuple of
+        blueprint name and status code, values are max-age seconds or Cache-Control strings
+
+        :param app: Flask instance
+        """
+        state = self._states.get(app)
+        state.cache_policies = {
+            k: 'public, max-age={}'.format(v) if isinstance(v, int) else v
+            for k, v in (app.config['ERROR_CACHE_POLICIES'] or {}).items()
+        }
+        state.etags = LRUCache(self.negotiation_cache_size) if state.cache_policies else None
+
+    def cache_policy(self, code):
+        """
+
+        :param code: http status code
+        :return: Cache-Control of blueprint of current request and status code, None if not cacheable
+        """
+        policies = self._states.current().cache_policies
+        if not policies or flask.request.method not in ('GET', 'HEAD'):
+            return None
+
+        blueprint = flask.request.blueprint or dispatched_blueprint.get()
+        policy = policies.get((blueprint, code))
+        return policy if policy is not None else policies.get(code)
+
+    def _apply_cache_policy(self, resp):
+        """
+        Adds Cache-Control, Vary and a strong ETag computed once for each body,
+        the response is replaced by a 304 if the ETag matches If-None-Match
+
+        :param resp: Flask response
+        :return: response
+        """
+        policy = self.cache_policy(resp.status_code)
+        if policy is None or resp.is_streamed:
+            return resp
+
+        resp.headers['Cache-Control'] = policy
+        resp.vary.add('Accept')
+
+        # problems may carry their own ETag
+        etag = resp.get_etag()[0]
+        if etag is None:
+            body = resp.get_data()
+            etags = self._states.current().etags
+            etag = etags.get(body)
+            if etag is None:
+                etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+                etags.set(body, etag)
+            resp.set_etag(etag)
+
+        if flask.request.if_none_match.contains(etag):
+            not_modified = flask.Response(status=304)
+            for h in ('ETag', 'Cache-Control', 'Vary'):
+                value = resp.headers.get(h)
+                if value is not None:
+                    not_modified.headers[h] = value
+            return not_modified
+        return resp
+
+    def render_page(self, ex):
+        """
+        Renders ERROR_PAGE, output is cached by template visible fields of problem
+        and by the result of ERROR_PAGE_CACHE_KEY function, if any
+
+        :param ex: ApiProblem instance
+        :return: rendered page
+        """
+        state = self._states.current()
+        page = state.settings.page
+        # errors may be a generator, they are not part of cache key
+        if state.page_cache is None or not page or ex.errors is not None:
+            with stage('render'):
+                return flask.render_template(page, error=ex)
+
+        # the loader returns a new template object when the source changed
+        template = cap.jinja_env.get_template(page)
+        try:
+            key = (
+                page, type(ex), ex.code, ex.name, ex.description,
+                ex.type, ex.instance, freeze(ex.headers), freeze(ex.response),
+                freeze([getattr(ex, n) for n in ex.extension_members]),
+                state.page_cache_key() if state.page_cache_key else None
+            )
+            hash(key)
+        except TypeError:
+            key = None
+
+        if key is not None:
+            cached = state.page_cache.get(key)
+            if cached is not None and cached[0] is template:
+                return cached[1]
+
+        with stage('render'):
+            rendered = flask.render_template(template, error=ex)
+
+        if key is not None:
+            state.page_cache.set(key, (template, rendered))
+        return rendered
+
+    def render_default(self, exc):
+        """
+
+        :param exc: ApiProblem instance
+        :return: default template of exception class rendered
+        """
+        source = exc.default_html_template
+        templates = self._states.current().templates
+        try:
+            template = templates[source]
+        except KeyError:
+            template = templates[source] = cap.jinja_env.from_string(source)
+
+        with stage('render'):
+            return flask.render_template(template, exc=exc)
+
+    @staticmethod
+    def load_json_encoder(encoder):
+        """
+
+        :param encoder: callable, name of default encoder or import string
+        :return: function that encodes a dict into json
+        """
+        if callable(encoder):
+            return encoder
+        if encoder in JSON_ENCODERS:
+            return JSON_ENCODERS[encoder]
+        return import_string(encoder)
+
+    def _encode_json(self, data):
+        """
+
+        :param data: problem dict
+        :return: json bytes or string
+        """
+        try:
+            return self._states.current().json_encoder(data)
+        except (TypeError, ValueError):
+            return fallback_json(data)
 
     def _default_response_builder(self, f):
         """
@@ -86,11 +601,22 @@ class ErrorHandler:
 
             if not h.get('Content-Type'):
                 h['Content-Type'] = 'application/{}+json'.format(self._exc_class.ct_id)
-            elif cap.config['ERROR_FORCE_CONTENT_TYPE'] is True:
+            elif self._states.current().settings.force_content_type:
                 h = self._force_content_type(h)
 
             options = dict(status=s, headers=h, mimetype=h['Content-Type'])
-            return flask.Response(flask.json.dumps(r), **options)
+            xml = h['Content-Type'].split(';', 1)[0].endswith('xml')
+
+            if r.get('errors') is not None:
+                # errors are streamed so memory does not grow with their number
+                body = problem_xml(r) if xml else problem_json(r, self._encode_json)
+                if flask.has_request_context():
+                    body = flask.stream_with_context(body)
+                return flask.Response(body, **options)
+
+            if xml:
+                return flask.Response(''.join(problem_xml(r)), **options)
+            return flask.Response(self._encode_json(r), **options)
 
         return wrapper
 
@@ -100,22 +626,41 @@ class ErrorHandler:
         :param hdr: headers dict
         :return: updated headers
         """
-        ct_id = self._exc_class.ct_id
-        ct = hdr.get('Content-Type') or 'x-application/{}'.format(ct_id)
+        hdr['Content-Type'] = self._rewrite_content_type(hdr.get('Content-Type'))
+        return hdr
 
-        if ct_id not in ct:
-            if any([i in ct for i in cap.config['ERROR_CONTENT_TYPES']]):
-                ct = "/{}+".format(ct_id).join(ct.split('/', maxsplit=1))
+    def _rewrite_content_type(self, ct):
+        """
+        Rewrites are cached by content type
 
-        hdr.update({'Content-Type': ct})
-        return hdr
+        :param ct: content type set by problem
+        :return: content type with ct_id of exception class
+        """
+        state = self._states.current()
+        try:
+            return state.content_types[ct]
+        except KeyError:
+            pass
+
+        ct_id = self._exc_class.ct_id
+        rewritten = ct or 'x-application/{}'.format(ct_id)
+        if ct_id not in rewritten:
+            if any(i in rewritten for i in state.settings.content_types):
+                rewritten = "/{}+".format(ct_id).join(rewritten.split('/', maxsplit=1))
+
+        if len(state.content_types) >= self.negotiation_cache_size:
+            state.content_types = {}
+        state.content_types[ct] = rewritten
+        return rewritten
 
     @staticmethod
-    def register(*bps, code=None):
+    def register(*bps, code=None, bulk=False):
         """
 
         :param bps: blueprint's list or flask app
         :param code: optional a specific http code otherwise all
+        :param bulk: register a single HTTPException handler instead of one for each http code,
+                     app handlers registered by code take precedence over it
         """
 
         def _register(hderr):
@@ -130,11 +675,16 @@ class ErrorHandler:
                     if code is not None:
                         b.errorhandler(code)(hderr)
                     else:
-                        for c in default_exceptions.keys():
-                            b.errorhandler(c)(hderr)
+                        if bulk:
+                            b.register_error_handler(HTTPException, hderr)
+                        else:
+                            for c in default_exceptions.keys():
+                                b.errorhandler(c)(hderr)
 
                         ErrorHandler.failure(b)(hderr)
 
+                ErrorDispatcher.invalidate()
+
             return wrapper()
 
         return _register
@@ -155,6 +705,7 @@ class ErrorHandler:
             @wraps(hderr)
             def wrapper():
                 bp.register_error_handler(Exception, hderr)
+                ErrorDispatcher.invalidate()
 
             return wrapper()
 
@@ -166,8 +717,59 @@ class ErrorHandler:
         :param ex: Exception instance
         :return: default template rendered response
         """
-        ex = self._normalizer.normalize(ex, self._exc_class)
-        return flask.render_template_string(ex.default_html_template, exc=ex), ex.code
+        if self._in_storm(ex):
+            return self._storm_response(ex, 'failure', 'html')
+
+        with trace(self._states.current().metrics, 'failure', ex) as t:
+            with stage('normalize'):
+                ex = t.problem = self._normalizer.normalize(ex, self._exc_class)
+            return self.render_default(ex), ex.code
+
+    def response_cache_stats(self):
+        """
+
+        :return: stats of response cache of current app or None if disabled
+        """
+        response_cache = self._states.current().response_cache
+        if response_cache is not None:
+            return response_cache.stats()
+        return None
+
+    def _response_cache_key(self, ex, content_type):
+        """
+
+        :param ex: ApiProblem instance
+        :param content_type: negotiated content type
+        :return: key of serialized response or None if the problem is not cacheable
+        """
+        if self._states.current().response_cache is None or not ex.cacheable or ex.errors is not None:
+            return None
+        # a custom response builder may add per request data
+        if self._response != self._default_response_builder:
+            return None
+
+        try:
+            return (
+                type(ex), ex.code, ex.description, content_type,
+                ex.type, ex.instance, freeze(ex.headers), freeze(ex.response),
+                freeze([getattr(ex, n) for n in ex.extension_members])
+            )
+        except TypeError:
+            return None
+
+    @staticmethod
+    def _prepare_response(ex, content_type):
+        """
+
+        :param ex: ApiProblem instance
+        :param content_type: negotiated content type, used if the problem does not set it, None to leave it unset
+        :return: dict response, status code and headers dict
+        """
+        with stage('prepare'):
+            r, s, h = ex.prepare_response()
+        if content_type is not None:
+            h.setdefault('Content-Type', content_type)
+        return r, s, h
 
     def _api_handler(self, ex):
         """
@@ -175,17 +777,48 @@ class ErrorHandler:
         :param ex: Exception instance
         :return: response built from self._response
         """
-        ex = self._normalizer.normalize(ex, self._exc_class)
+        if self._in_storm(ex):
+            return self._storm_response(ex, 'api', self.negotiate())
 
-        if isinstance(ex.response, flask.Response):
-            return ex.response, ex.code
+        state = self._states.current()
+        with trace(state.metrics, 'api', ex) as t:
+            with stage('normalize'):
+                ex = t.problem = self._normalizer.normalize(ex, self._exc_class)
 
-        resp = self._response(lambda: ex.prepare_response())()
+            if isinstance(ex.response, flask.Response):
+                return ex.response, ex.code
 
-        if cap.config['ERROR_FORCE_CONTENT_TYPE'] is True:
-            resp.headers = self._force_content_type(resp.headers)
+            # only the default response builder knows how to serialize the negotiated format
+            content_type = None
+            if self._response == self._default_response_builder:
+                content_type = "application/{}+{}".format(ex.ct_id, self.negotiate())
 
-        return resp
+            key = self._response_cache_key(ex, content_type)
+            if key is not None:
+                cached = state.response_cache.get(key)
+                if cached is not None:
+                    body, status, headers = cached
+                    resp = flask.Response(body, status=status, headers=headers)
+                    return self._apply_cache_policy(resp) if state.cache_policies else resp
+
+            with stage('serialize'):
+                resp = self._response(lambda: self._prepare_response(ex, content_type))()
+
+                # default response builder has already forced it
+                if state.settings.force_content_type and self._response != self._default_response_builder:
+                    resp.headers = self._force_content_type(resp.headers)
+
+            if not isinstance(resp, flask.Response):
+                return resp
+            if content_type is not None and state.negotiable:
+                resp.vary.add('Accept')
+            if resp.is_streamed:
+                return resp
+
+            if key is not None:
+                state.response_cache.set(key, (resp.get_data(), resp.status_code, list(resp.headers)))
+
+            return self._apply_cache_policy(resp) if state.cache_policies else resp
 
     def _web_handler(self, ex):
         """
@@ -193,17 +826,38 @@ class ErrorHandler:
         :param ex: Exception instance
         :return: a template rendered response
         """
-        ex = self._normalizer.normalize(ex, self._exc_class)
-
-        if cap.config['ERROR_XHR_ENABLED'] is True:
-            # check if request is XHR (for compatibility with old clients)
-            if flask.request.headers.get('X-Requested-With', '').lower() == "xmlhttprequest":
-                return self._api_handler(ex)
-
-        try:
-            return flask.render_template(cap.config['ERROR_PAGE'], error=ex), ex.code
-        except TemplateError:
-            return flask.render_template_string(ex.default_html_template, exc=ex), ex.code
+        if self._in_storm(ex):
+            return self._storm_response(ex, 'web', self.negotiate(web=True))
+
+        state = self._states.current()
+        with trace(state.metrics, 'web', ex) as t:
+            with stage('normalize'):
+                ex = t.problem = self._normalizer.normalize(ex, self._exc_class)
+
+            xhr = False
+            if state.settings.xhr_enabled:
+                # check if request is XHR (for compatibility with old clients)
+                xhr = flask.request.headers.get('X-Requested-With', '').lower() == "xmlhttprequest"
+
+            if xhr or self.negotiate(web=True) != 'html':
+                resp = self._api_handler(ex)
+                if not isinstance(resp, flask.Response):
+                    return resp
+            else:
+                try:
+                    page = self.render_page(ex)
+                except TemplateError:
+                    page = self.render_default(ex)
+
+                resp = flask.make_response(page, ex.code)
+                if self.cache_policy(ex.code) is not None:
+                    resp = self._apply_cache_policy(resp)
+
+            # html or problem is chosen by request headers
+            resp.vary.add('Accept')
+            if state.settings.xhr_enabled:
+                resp.vary.add('X-Requested-With')
+            return resp
 
     def default_register(self, *bps):
         """
@@ -211,7 +865,7 @@ class ErrorHandler:
         :param bps:
         """
         for b in bps:
-            ErrorHandler.register(b)(self._failure_handler)
+            ErrorHandler.register(b, bulk=self._bulk)(self._failure_handler)
 
     def failure_register(self, *bps, callback=None):
         """
@@ -229,6 +883,7 @@ class ErrorHandler:
         :param callback: optional function to register
         :param kwargs: passed to register
         """
+        kwargs.setdefault('bulk', self._bulk)
         for b in bps:
             ErrorHandler.register(b, **kwargs)(callback or self._api_handler)
 
@@ -239,6 +894,7 @@ class ErrorHandler:
         :param callback: optional function to register
         :param kwargs: passed to register
         """
+        kwargs.setdefault('bulk', self._bulk)
         for b in bps:
             ErrorHandler.register(b, **kwargs)(callback or self._web_handler)
 
@@ -267,6 +923,8 @@ class ErrorHandler:
                 )
                 return
 
+        d = dispatcher_class()
+
         for c in codes:
             @app.errorhandler(c)
             def error_handler(exc):
@@ -275,5 +933,11 @@ class ErrorHandler:
                 :param exc: Exception instance
                 :return: dispatcher response
                 """
-                d = dispatcher_class()
-                return d.dispatch(self._normalizer.normalize(exc, self._exc_class))
+                with trace(self._states.current().metrics, 'dispatcher', exc) as t:
+                    with stage('normalize'):
+                        exc = t.problem = self._normalizer.normalize(exc, self._exc_class)
+                    with stage('dispatch'):
+                        response = d.dispatch_request_blueprint(exc)
+                        if response is not None:
+                            return response
+                        return d.dispatch(exc)
@@ -0,0 +1,331 @@
+import copy
+import hashlib
+import json
+import linecache
+import logging
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+CAUSE_MESSAGE = "\nThe above exception was the direct cause of the following exception:\n\n"
+CONTEXT_MESSAGE = "\nDuring handling of the above exception, another exception occurred:\n\n"
+
+
+class ExceptionDump:
+    max_chain = 5
+    fingerprint_frames = 5
+
+    def __init__(self, exc=None, limit=None):
+        """
+        Captures an exception, frames are extracted and formatted only when requested.
+        Source lines are read from linecache without checking files for changes
+
+        :param exc: exception instance, default the one currently handled
+        :param limit: max number of innermost frames kept for each exception
+        """
+        self.exc = exc if exc is not None else sys.exc_info()[1]
+        self.limit = limit
+        self._raw = None
+        self._chain = None
+        self._text = None
+        self._fingerprint = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self.format()
+        return self._text
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the exception by its type and the innermost frames
+
+        :return: hex digest
+        """
+        if self._fingerprint is None:
+            frames = [
+                (f.f_code.co_filename, f.f_code.co_name, lineno)
+                for f, lineno in traceback.walk_tb(self.exc.__traceback__)
+            ]
+            exc_type = type(self.exc)
+            data = repr((exc_type.__module__, exc_type.__qualname__, frames[-self.fingerprint_frames:]))
+            self._fingerprint = hashlib.blake2b(data.encode(), digest_size=8).hexdigest()
+        return self._fingerprint
+
+    def extract(self, exc):
+        """
+
+        :param exc: exception instance
+        :return: list of frames as tuple: filename, line number, function name
+        """
+        frames = [
+            (f.f_code.co_filename, lineno, f.f_code.co_name)
+            for f, lineno in traceback.walk_tb(exc.__traceback__)
+        ]
+        if self.limit:
+            frames = frames[-self.limit:]
+        return frames
+
+    def collect(self):
+        """
+        Exceptions from the innermost cause to the captured one, frames without source lines
+
+        :return: list of dict
+        """
+        if self._raw is None:
+            raw, exc, seen = [], self.exc, set()
+            while exc is not None and id(exc) not in seen and len(raw) < self.max_chain:
+                seen.add(id(exc))
+                if exc.__cause__ is not None:
+                    reason, cause = CAUSE_MESSAGE, exc.__cause__
+                elif exc.__context__ is not None and not exc.__suppress_context__:
+                    reason, cause = CONTEXT_MESSAGE, exc.__context__
+                else:
+                    reason, cause = None, None
+
+                raw.append(dict(
+                    type=type(exc).__qualname__,
+                    module=type(exc).__module__,
+                    message=str(exc),
+                    frames=self.extract(exc),
+                    reason=reason
+                ))
+                exc = cause
+
+            raw.reverse()
+            self._raw = raw
+        return self._raw
+
+    @property
+    def chain(self):
+        """
+        Exceptions from the innermost cause to the captured one, with frames and cause message
+
+        :return: list of dict
+        """
+        if self._chain is None:
+            self._chain = [
+                dict(e, frames=[
+                    dict(filename=filename, lineno=lineno, name=name, line=linecache.getline(filename, lineno).strip())
+                    for filename, lineno, name in e['frames']
+                ])
+                for e in self.collect()
+            ]
+        return self._chain
+
+    def detach(self):
+        """
+        Copy without references to exception, so frames and their locals are released
+        while the dump waits to be formatted, i.e. in log queue
+
+        :return: ExceptionDump instance
+        """
+        dump = copy.copy(self)
+        dump.collect()
+        dump._fingerprint = self.fingerprint
+        dump.exc = None
+        return dump
+
+    @property
+    def frames(self):
+        """
+
+        :return: frames of captured exception
+        """
+        return self.chain[-1]['frames'] if self.chain else []
+
+    def as_dict(self):
+        """
+
+        :return: structured data usable by log formatters
+        """
+        return dict(exception=self.chain[-1] if self.chain else None, chain=self.chain)
+
+    def format(self):
+        """
+
+        :return: traceback formatted like traceback.format_exc
+        """
+        lines = []
+        for i, e in enumerate(self.chain):
+            if i > 0:
+                lines.append(e['reason'])
+            lines.append("Traceback (most recent call last):\n")
+            for f in e['frames']:
+                lines.append('  File "{filename}", line {lineno}, in {name}\n'.format(**f))
+                if f['line']:
+                    lines.append("    {}\n".format(f['line']))
+
+            name = e['type'] if e['module'] in ('builtins', '__main__') else "{module}.{type}".format(**e)
+            lines.append("{}: {}\n".format(name, e['message']) if e['message'] else "{}\n".format(name))
+
+        return ''.join(lines)
+
+
+class LogSampler:
+    def __init__(self, window=60, max_fingerprints=1000):
+        """
+        Deduplicates logs by fingerprint: the first occurrence is logged in full,
+        the repeats within the window are counted and reported as a summary.
+        Expired windows are swept whenever any fingerprint is sampled,
+        so the repeats of an exception that stops occurring are reported too
+
+        :param window: seconds of sampling window
+        :param max_fingerprints: max number of fingerprints tracked, the least recent are discarded
+        """
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self._seen = OrderedDict()  # ordered by start of window
+        self._lock = threading.Lock()
+
+    def sample(self, fingerprint, name=None):
+        """
+
+        :param fingerprint: fingerprint of exception
+        :param name: name of exception reported in summary
+        :return: tuple: (True if it must be logged in full, list of expired windows to report as (name, fingerprint, repeats))
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(fingerprint)
+            if entry is None:
+                self._seen[fingerprint] = [now, 0, name]
+                while len(self._seen) > self.max_fingerprints:
+                    self._seen.popitem(last=False)
+                return True, self._sweep(now)
+
+            if now - entry[0] < self.window:
+                entry[1] += 1
+                return False, self._sweep(now)
+
+            repeats = entry[1]
+            self._seen.move_to_end(fingerprint)
+            entry[0], entry[1] = now, 1 if repeats else 0
+            reports = self._sweep(now)
+            if repeats:
+                reports.insert(0, (entry[2], fingerprint, repeats))
+            return not repeats, reports
+
+    def _sweep(self, now):
+        """
+        Discards expired windows from the oldest, must be called with lock held
+
+        :param now: monotonic time
+        :return: list of (name, fingerprint, repeats) of expired windows with repeats
+        """
+        reports = []
+        while self._seen:
+            fingerprint, entry = next(iter(self._seen.items()))
+            if now - entry[0] < self.window:
+                break
+            del self._seen[fingerprint]
+            if entry[1]:
+                reports.append((entry[2], fingerprint, entry[1]))
+        return reports
+
+
+class ErrorLogQueue:
+    _stop = object()
+
+    def __init__(self, handler, maxsize=10000, batch_size=100):
+        """
+        Writes structured events as newline delimited json from a background thread,
+        events are dropped if the queue is full
+
+        :param handler: logging.Handler instance, its formatter should be '%(message)s'
+        :param maxsize: max number of events in queue
+        :param batch_size: max number of events written before flush
+        """
+        self.handler = handler
+        self.batch_size = batch_size
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the writer thread
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, name='errors-handler-log', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Writes queued events and stops the writer thread
+
+        :param timeout: seconds to wait for the writer thread
+        """
+        if self._thread is not None:
+            try:
+                self._queue.put(self._stop, timeout=timeout)
+                self._thread.join(timeout)
+            except queue.Full:  # pragma: no cover
+                pass
+            self._thread = None
+
+    def put(self, event):
+        """
+
+        :param event: dict, values not serializable are converted to string by writer thread
+        :return: False if the event was dropped
+        """
+        try:
+            self._queue.put_nowait(event)
+            self.queued += 1
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stats(self):
+        """
+
+        :return: dict with counters
+        """
+        return dict(
+            queued=self.queued, dropped=self.dropped, written=self.written,
+            batches=self.batches, pending=self._queue.qsize()
+        )
+
+    def write(self, batch):
+        """
+
+        :param batch: list of events
+        """
+        for event in batch:
+            message = json.dumps(event, default=str)
+            self.handler.handle(logging.makeLogRecord(dict(
+                name=__name__, msg=message, levelno=logging.ERROR, levelname='ERROR'
+            )))
+        self.handler.flush()
+        self.written += len(batch)
+        self.batches += 1
+
+    def _worker(self):
+        while True:
+            batch, stop = [self._queue.get()], False
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if self._stop in batch:
+                batch = [e for e in batch if e is not self._stop]
+                stop = True
+
+            try:
+                if batch:
+                    self.write(batch)
+            except Exception:  # pragma: no cover
+                traceback.print_exc()
+
+            if stop:
+                return
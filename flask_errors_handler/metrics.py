@@ -0,0 +1,260 @@
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+import flask
+
+from .signals import connected, stage_finished, stage_started
+
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0
+)
+
+_current_trace = ContextVar('errors_handler_trace', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+
+        :param buckets: sorted upper bounds in seconds
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+
+        :param value: seconds
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        """
+
+        :return: cumulative counts by upper bound, sum and count
+        """
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return dict(buckets=buckets, sum=self.sum, count=self.count)
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='flask_errors'):
+        """
+
+        :param buckets: upper bounds of latency histograms
+        :param prefix: prefix of metrics name in prometheus format
+        """
+        self.buckets = buckets
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def count(self, code, blueprint, exception, handler):
+        """
+
+        :param code: http status code
+        :param blueprint: blueprint name
+        :param exception: exception class name
+        :param handler: kind of handler: api, web, failure or dispatcher
+        """
+        key = (code, blueprint or '', exception, handler)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def observe(self, stage, seconds):
+        """
+
+        :param stage: stage name: normalize, dispatch, serialize or render
+        :param seconds: elapsed time
+        """
+        with self._lock:
+            try:
+                self.histograms[stage].observe(seconds)
+            except KeyError:
+                self.histograms[stage] = Histogram(self.buckets)
+                self.histograms[stage].observe(seconds)
+
+    def clear(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """
+
+        :return: dict with errors counters and latency histograms by stage
+        """
+        with self._lock:
+            return dict(
+                errors=[
+                    dict(code=k[0], blueprint=k[1], exception=k[2], handler=k[3], count=v)
+                    for k, v in self.counters.items()
+                ],
+                stages={k: v.to_dict() for k, v in self.histograms.items()}
+            )
+
+    @staticmethod
+    def _labels(**labels):
+        def escape(v):
+            return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        return ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels.items())
+
+    def to_prometheus(self):
+        """
+
+        :return: metrics in prometheus text format
+        """
+        data = self.snapshot()
+        lines = [
+            "# HELP {}_total Errors handled".format(self.prefix),
+            "# TYPE {}_total counter".format(self.prefix),
+        ]
+        for c in data['errors']:
+            count = c.pop('count')
+            lines.append("{}_total{{{}}} {}".format(self.prefix, self._labels(**c), count))
+
+        name = "{}_stage_seconds".format(self.prefix)
+        lines.append("# HELP {} Time spent in error handling stages".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for stage, h in data['stages'].items():
+            for bound, count in h['buckets'].items():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append("{}_bucket{{{}}} {}".format(name, self._labels(stage=stage, le=le), count))
+            lines.append("{}_sum{{{}}} {}".format(name, self._labels(stage=stage), h['sum']))
+            lines.append("{}_count{{{}}} {}".format(name, self._labels(stage=stage), h['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+class Stage:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        t = self.trace
+        if t.hooks:
+            stage_started.send(t.app, stage=self.name, kind=t.kind, problem=t.problem, elapsed=None)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = perf_counter() - self.start
+        t = self.trace
+        if t.registry is not None:
+            t.registry.observe(self.name, elapsed)
+        if t.hooks:
+            stage_finished.send(t.app, stage=self.name, kind=t.kind, problem=t.problem, elapsed=elapsed)
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Trace:
+    def __init__(self, registry, kind, exc, hooks=False):
+        """
+        Collects metrics of an error and sends stage signals,
+        nested handlers share the trace of the outermost
+
+        :param registry: MetricsRegistry instance or None
+        :param kind: kind of handler
+        :param exc: original exception
+        :param hooks: if True stage signals are sent
+        """
+        self.registry = registry
+        self.hooks = hooks
+        self.app = flask.current_app._get_current_object() if hooks else None
+        self.kind = kind
+        self.exception = type(exc).__name__
+        self.problem = None
+        self._depth = 0
+        self._token = None
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._token = _current_trace.set(self)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self._depth -= 1
+        if self._depth == 0:
+            _current_trace.reset(self._token)
+            if self.registry is not None and self.problem is not None:
+                blueprint = flask.request.blueprint if flask.has_request_context() else None
+                self.registry.count(self.problem.code, blueprint, self.exception, self.kind)
+
+    def stage(self, name):
+        """
+
+        :param name: stage name
+        :return: context manager that measures the stage
+        """
+        return Stage(self, name)
+
+
+class NullTrace(NullStage):
+    problem = None
+
+    def __setattr__(self, key, value):
+        pass
+
+    def stage(self, name):
+        return NULL_STAGE
+
+
+NULL_TRACE = NullTrace()
+
+
+def trace(registry, kind, exc):
+    """
+
+    :param registry: MetricsRegistry instance or None if metrics are disabled
+    :param kind: kind of handler
+    :param exc: original exception
+    :return: the current trace if any, otherwise a new one, a null one if there is nothing to collect
+    """
+    current = _current_trace.get()
+    if current is not None:
+        return current
+
+    # receivers are checked once for each error, not for each stage
+    hooks = connected(stage_started, stage_finished)
+    if registry is None and not hooks:
+        return NULL_TRACE
+    return Trace(registry, kind, exc, hooks)
+
+
+def stage(name):
+    """
+
+    :param name: stage name
+    :return: context manager that measures the stage within the current trace
+    """
+    current = _current_trace.get()
+    if current is None:
+        return NULL_STAGE
+    return current.stage(name)
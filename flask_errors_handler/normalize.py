@@ -1,14 +1,39 @@
-import traceback
+import atexit
+import logging
+import time
+from contextvars import ContextVar
 from datetime import datetime
+from logging.handlers import RotatingFileHandler
 
-from flask import current_app as cap
+from flask import current_app as cap, has_request_context, request
 from werkzeug import exceptions, http
 from werkzeug.routing import RequestRedirect
 
 from .exception import ApiProblem
+from .logs import ErrorLogQueue, ExceptionDump, LogSampler
+from .recorder import ProblemRecorder, ProblemStore
+from .shared import SharedCounters
+from .settings import AppStates, Settings
+
+
+_last_recorded = ContextVar('errors_handler_last_recorded', default=None)
 
 
 class BaseNormalize(object):
+    def init_app(self, app):
+        """
+        Child class must call super().init_app() so as to keep the chain of Mixins
+
+        :param app: Flask instance
+        """
+
+    def reload_settings(self, app):
+        """
+        Child class must call super().reload_settings() so as to keep the chain of Mixins
+
+        :param app: Flask instance
+        """
+
     def normalize(self, ex, **kwargs):
         """
         Child class must return super().normalize() so as to keep the chain of Mixins
@@ -19,6 +44,73 @@ class BaseNormalize(object):
         return ex
 
 
+def redirect_normalizer(ex):
+    """
+
+    :param ex: RequestRedirect
+    """
+    location = dict(location=ex.new_url)
+    ex.headers = location
+    ex.response = location
+
+
+def method_not_allowed_normalizer(ex):
+    """
+
+    :param ex: MethodNotAllowed
+    """
+    if isinstance(ex.valid_methods, (list, tuple)):
+        methods = ex.valid_methods
+    else:
+        methods = (ex.valid_methods,)
+    try:
+        ex.headers = dict(Allow=", ".join(methods))
+        ex.response = dict(allowed=methods)
+    except TypeError:  # pragma: no cover
+        pass
+
+
+def unauthorized_normalizer(ex):
+    """
+
+    :param ex: Unauthorized
+    """
+
+    def to_dict(item):
+        item = dict(item)
+        item['auth_type'] = item.pop('__auth_type__', None)
+        return item
+
+    if ex.www_authenticate:
+        ex.headers = {"WWW-Authenticate": ", ".join([str(a) for a in ex.www_authenticate])}
+        ex.response = dict(authenticate=[to_dict(a) for a in ex.www_authenticate if a])
+
+
+def range_normalizer(ex):
+    """
+
+    :param ex: RequestedRangeNotSatisfiable
+    """
+    if ex.length:
+        unit = ex.units or 'bytes'
+        ex.headers = {"Content-Range": f"{unit} */{ex.length}"}
+        ex.response = dict(units=unit, length=ex.length)
+
+
+def retry_after_normalizer(ex):
+    """
+
+    :param ex: TooManyRequests or ServiceUnavailable
+    """
+    if ex.retry_after:
+        retry = ex.retry_after
+        if isinstance(retry, datetime):
+            retry = http.http_date(retry)
+
+        ex.headers = {"Retry-After": str(retry)}
+        ex.response = dict(retry_after=ex.retry_after)
+
+
 class RequestRedirectMixin(BaseNormalize):
     def normalize(self, ex, **kwargs):
         """
@@ -27,9 +119,7 @@ class RequestRedirectMixin(BaseNormalize):
         :return:
         """
         if isinstance(ex, RequestRedirect):
-            location = dict(location=ex.new_url)
-            ex.headers = location
-            ex.response = location
+            redirect_normalizer(ex)
 
         return super().normalize(ex)
 
@@ -42,15 +132,7 @@ class MethodNotAllowedMixin(BaseNormalize):
         :return:
         """
         if isinstance(ex, exceptions.MethodNotAllowed):
-            if isinstance(ex.valid_methods, (list, tuple)):
-                methods = ex.valid_methods
-            else:
-                methods = (ex.valid_methods,)
-            try:
-                ex.headers = dict(Allow=", ".join(methods))
-                ex.response = dict(allowed=methods)
-            except TypeError:  # pragma: no cover
-                pass
+            method_not_allowed_normalizer(ex)
 
         return super().normalize(ex)
 
@@ -62,16 +144,8 @@ class UnauthorizedMixin(BaseNormalize):
         :param ex:
         :return:
         """
-
-        def to_dict(item):
-            item = dict(item)
-            item['auth_type'] = item.pop('__auth_type__', None)
-            return item
-
         if isinstance(ex, exceptions.Unauthorized):
-            if ex.www_authenticate:
-                ex.headers = {"WWW-Authenticate": ", ".join([str(a) for a in ex.www_authenticate])}
-                ex.response = dict(authenticate=[to_dict(a) for a in ex.www_authenticate if a])
+            unauthorized_normalizer(ex)
 
         return super().normalize(ex)
 
@@ -84,10 +158,7 @@ class RequestedRangeNotSatisfiableMixin(BaseNormalize):
         :return:
         """
         if isinstance(ex, exceptions.RequestedRangeNotSatisfiable):
-            if ex.length:
-                unit = ex.units or 'bytes'
-                ex.headers = {"Content-Range": f"{unit} */{ex.length}"}
-                ex.response = dict(units=unit, length=ex.length)
+            range_normalizer(ex)
 
         return super().normalize(ex)
 
@@ -100,68 +171,334 @@ class RetryAfterMixin(BaseNormalize):
         :return:
         """
         if isinstance(ex, (exceptions.TooManyRequests, exceptions.ServiceUnavailable)):
-            if ex.retry_after:
-                retry = ex.retry_after
-                if isinstance(retry, datetime):
-                    retry = http.http_date(retry)
+            retry_after_normalizer(ex)
+
+        return super().normalize(ex)
+
+
+class RegistryMixin(BaseNormalize):
+    """
+        Applies the normalizer function registered for the exception type,
+        it replaces the chain of isinstance checks done by the mixins above
+    """
+    normalizers = {
+        RequestRedirect: redirect_normalizer,
+        exceptions.MethodNotAllowed: method_not_allowed_normalizer,
+        exceptions.Unauthorized: unauthorized_normalizer,
+        exceptions.RequestedRangeNotSatisfiable: range_normalizer,
+        exceptions.TooManyRequests: retry_after_normalizer,
+        exceptions.ServiceUnavailable: retry_after_normalizer,
+    }
+
+    _resolved = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._resolved = {}
+
+    @classmethod
+    def register(cls, *exc_types):
+        """
+        Registers a function that takes only the exception as argument
+        for the given exception types, subclasses included
+
+        :param exc_types: exception classes
+        """
+
+        def _register(func):
+            cls.normalizers = {**cls.normalizers, **{t: func for t in exc_types}}
+            cls._resolved = {}
+            return func
+
+        return _register
+
+    @classmethod
+    def resolve(cls, exc_type):
+        """
+        Finds the normalizer of the nearest class in exception MRO,
+        the result is cached per exception type
+
+        :param exc_type: exception class
+        :return: normalizer function or None
+        """
+        try:
+            return cls._resolved[exc_type]
+        except KeyError:
+            pass
+
+        func = None
+        for c in exc_type.__mro__:
+            func = cls.normalizers.get(c)
+            if func is not None:
+                break
 
-                ex.headers = {"Retry-After": str(retry)}
-                ex.response = dict(retry_after=ex.retry_after)
+        cls._resolved[exc_type] = func
+        return func
+
+    def normalize(self, ex, **kwargs):
+        """
+
+        :param ex:
+        :return:
+        """
+        func = self.resolve(type(ex))
+        if func is not None:
+            func(ex)
 
         return super().normalize(ex)
 
 
+class NormalizerState:
+    __slots__ = ('settings', 'sampler', 'log_queue', 'recorder', 'counters')
+
+    def __init__(self):
+        """
+            State of normalizer for a Flask app
+        """
+        self.settings = None
+        self.sampler = None
+        self.log_queue = None
+        self.recorder = None
+        self.counters = None
+
+    def stop(self):
+        """
+        Stops background writers and closes shared counters
+        """
+        if self.log_queue is not None:
+            self.log_queue.stop()
+        if self.recorder is not None and self.recorder.store is not None:
+            self.recorder.store.stop()
+        if self.counters is not None:
+            self.counters.close()
+
+
+def _state_property(name):
+    """
+
+    :param name: attribute of NormalizerState
+    :return: property that reads it from the state of current app
+    """
+    return property(lambda self: getattr(self.state(), name, None))
+
+
 class NormalizerMixin(BaseNormalize):
-    class DumpEx:
-        def __str__(self):
-            return traceback.format_exc()
+    DumpEx = ExceptionDump
+
+    _states = None
+    settings = _state_property('settings')
+    log_queue = _state_property('log_queue')
+    recorder = _state_property('recorder')
+    counters = _state_property('counters')
+    _sampler = _state_property('sampler')
 
-    def normalize(self, ex, exc_class=ApiProblem, **kwargs):
+    def state(self):
+        """
+
+        :return: NormalizerState of current app or None if not initialized
+        """
+        return self._states.current() if self._states is not None else None
+
+    def init_app(self, app):
+        """
+
+        :param app: Flask instance
+        """
+        super().init_app(app)
+
+        if self._states is None:
+            self._states = AppStates()
+
+        previous = self._states.get(app)
+        if previous is not None:
+            previous.stop()
+
+        state = NormalizerState()
+        window = app.config['ERROR_LOG_SAMPLING_WINDOW']
+        if window:
+            state.sampler = LogSampler(window, app.config['ERROR_LOG_SAMPLING_MAX'])
+
+        if app.config['ERROR_LOG_QUEUE']:
+            state.log_queue = ErrorLogQueue(self.log_handler(app), app.config['ERROR_LOG_QUEUE_SIZE'])
+            state.log_queue.start()
+            atexit.register(state.log_queue.stop)
+
+        if app.config['ERROR_RECORDER_SIZE']:
+            store = None
+            if app.config['ERROR_RECORDER_SQLITE']:
+                store = ProblemStore(app.config['ERROR_RECORDER_SQLITE'])
+                store.start()
+                atexit.register(store.stop)
+
+            state.recorder = ProblemRecorder(
+                app.config['ERROR_RECORDER_SIZE'],
+                traceback_size=app.config['ERROR_RECORDER_TRACEBACK'],
+                store=store
+            )
+
+        if app.config['ERROR_SHARED_COUNTERS']:
+            state.counters = SharedCounters(
+                app.config['ERROR_SHARED_COUNTERS'],
+                slots=app.config['ERROR_SHARED_COUNTERS_SLOTS']
+            )
+
+        self._states.set(app, state)
+
+    def reload_settings(self, app):
+        """
+        Takes a snapshot of configuration used by normalize
+
+        :param app: Flask instance
+        """
+        super().reload_settings(app)
+        state = self._states.get(app) if self._states is not None else None
+        if state is not None:
+            state.settings = Settings.from_config(app.config)
+
+    @staticmethod
+    def log_handler(app):
+        """
+
+        :param app: Flask instance
+        :return: logging.Handler used by log queue
+        """
+        handler = app.config['ERROR_LOG_HANDLER']
+        if handler is None:
+            if app.config['ERROR_LOG_FILE']:
+                handler = RotatingFileHandler(
+                    app.config['ERROR_LOG_FILE'],
+                    maxBytes=app.config['ERROR_LOG_FILE_MAX_BYTES'],
+                    backupCount=app.config['ERROR_LOG_FILE_BACKUPS'],
+                    delay=True
+                )
+            else:
+                handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+        return handler
+
+    def log_repeats(self, reports, state=None):
+        """
+
+        :param reports: list of (name, fingerprint, repeats) returned by LogSampler
+        :param state: NormalizerState, default the one of current app
+        """
+        state = state or self.state()
+        for name, fingerprint, repeats in reports:
+            message = "{}: {} more in last {}s (fingerprint: {})".format(
+                name, repeats, state.sampler.window, fingerprint
+            )
+            if state.log_queue is not None:
+                state.log_queue.put(dict(time=time.time(), message=message, fingerprint=fingerprint))
+            else:
+                cap.logger.error("%s", message)
+
+    def log_exception(self, tb, problem, minimal=False):
+        """
+
+        :param tb: ExceptionDump instance
+        :param problem: ApiProblem instance
+        :param minimal: if True a single line is logged instead of the traceback
+        """
+        state = self.state()
+        log_queue = state.log_queue if state is not None else None
+
+        if state is not None and state.sampler is not None:
+            log, reports = state.sampler.sample(tb.fingerprint, type(tb.exc).__name__)
+            if reports:
+                self.log_repeats(reports, state)
+            if not log:
+                return
+
+        if minimal:
+            message = "{}: {} (fingerprint: {})".format(type(tb.exc).__name__, tb.exc, tb.fingerprint)
+            if log_queue is not None:
+                log_queue.put(dict(time=time.time(), message=message, fingerprint=tb.fingerprint))
+            else:
+                cap.logger.error("%s", message)
+        elif log_queue is not None:
+            # the traceback is formatted by the writer thread, frames are not kept alive meanwhile
+            log_queue.put(dict(
+                time=time.time(),
+                code=problem.code,
+                type=problem.get_type(),
+                instance=problem.get_instance(),
+                path=request.path if has_request_context() else None,
+                fingerprint=tb.fingerprint,
+                traceback=tb.detach(),
+            ))
+        else:
+            cap.logger.error("%s", tb, extra=dict(exception_dump=tb))
+
+    def record(self, problem, tb=None):
+        """
+        Records the problem once even if it is normalized more times by nested handlers
+
+        :param problem: ApiProblem instance
+        :param tb: optional ExceptionDump of original exception
+        """
+        state = self.state()
+        if state is None or (state.recorder is None and state.counters is None):
+            return
+        if _last_recorded.get() is problem:
+            return
+        _last_recorded.set(problem)
+
+        if state.recorder is not None:
+            state.recorder.record(problem, tb)
+        if state.counters is not None:
+            state.counters.count(problem.code, tb.fingerprint if tb is not None else None)
+
+    def normalize(self, ex, exc_class=ApiProblem, minimal=False, **kwargs):
         """
 
         :param ex: Exception
         :param exc_class: overrides ApiProblem class
+        :param minimal: if True traceback is never formatted, i.e. during error storms
         :return: new Exception instance of HTTPException
         """
         ex = super().normalize(ex)
 
         if isinstance(ex, exc_class):
+            self.record(ex)
             return ex
 
-        tb = self.DumpEx()
-        if cap.config['DEBUG']:
-            mess = str(tb)  # pragma: no cover
+        settings = self.settings or Settings.from_config(cap.config)
+
+        tb = None
+        if not isinstance(ex, exceptions.HTTPException):
+            tb = self.DumpEx(ex, limit=settings.traceback_limit)
+
+        # debug is read live, it is usually set after init_app, i.e. by app.run(debug=True)
+        if tb is not None and not minimal and cap.debug:
+            mess = str(tb)
         else:
-            mess = cap.config['ERROR_DEFAULT_MSG']
+            mess = settings.default_msg
 
         _ex = exc_class(mess, **kwargs)
 
-        if isinstance(ex, exceptions.HTTPException):
+        if tb is None:
+            # overridden getters may read the request, their output is not in the cache key
+            _ex.cacheable = not exc_class.custom_serialization
             _ex.code = ex.code
             _ex.description = ex.get_description()
             try:
                 _ex.response = ex.response
             except AttributeError:
                 _ex.response = None
-            try:
-                # noinspection PyUnresolvedReferences
-                _ex.headers.update(ex.headers)
-            except AttributeError:
-                pass
+            headers = getattr(ex, 'headers', None)
+            if headers:
+                _ex.update_headers(headers)
         else:
-            cap.logger.error("%s", tb)
+            self.log_exception(tb, _ex, minimal)
 
+        self.record(_ex, tb)
         return _ex
 
 
 class DefaultNormalizer(
     NormalizerMixin,
-    MethodNotAllowedMixin,
-    RequestRedirectMixin,
-    UnauthorizedMixin,
-    RequestedRangeNotSatisfiableMixin,
-    RetryAfterMixin,
+    RegistryMixin,
 ):
     """
-        Default normalizer uses all mixins
+        Default normalizer uses the registry of normalizers by exception type
     """
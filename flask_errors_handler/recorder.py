@@ -0,0 +1,147 @@
+import sqlite3
+import time
+from collections import OrderedDict, deque
+
+from flask import Blueprint, current_app as cap, request
+
+from .logs import ErrorLogQueue
+
+
+class ProblemRecorder:
+    fields = ('time', 'code', 'type', 'path', 'fingerprint')
+    max_path = 256
+
+    def __init__(self, size=1000, max_fingerprints=1000, traceback_size=2000, store=None):
+        """
+        Records recent problems in a ring buffer, the oldest are discarded.
+        Tracebacks are formatted and kept only for the first occurrence of a fingerprint
+
+        :param size: max number of problems recorded
+        :param max_fingerprints: max number of fingerprints indexed, the least recent are discarded
+        :param traceback_size: max number of characters kept of tracebacks, the innermost frames are kept
+        :param store: optional ProblemStore that persists problems
+        """
+        self.size = size
+        self.max_fingerprints = max_fingerprints
+        self.traceback_size = traceback_size
+        self.store = store
+        self._buffer = deque(maxlen=size)
+        self._index = OrderedDict()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def record(self, problem, tb=None):
+        """
+
+        :param problem: ApiProblem instance
+        :param tb: optional ExceptionDump of original exception
+        """
+        fingerprint = tb.fingerprint if tb is not None else None
+        try:
+            path = request.path[:self.max_path]
+        except RuntimeError:  # outside of request context
+            path = None
+
+        item = (time.time(), problem.code, problem.get_type(), path, fingerprint)
+        self._buffer.append(item)  # atomic
+
+        entry = None
+        if fingerprint is not None:
+            entry = self._index.get(fingerprint)
+            if entry is None:
+                entry = self._index[fingerprint] = dict(
+                    fingerprint=fingerprint, code=problem.code, count=0, first=item[0],
+                    traceback=str(tb)[-self.traceback_size:]
+                )
+                while len(self._index) > self.max_fingerprints:
+                    try:
+                        self._index.popitem(last=False)
+                    except KeyError:  # pragma: no cover
+                        break
+            entry['count'] += 1
+            entry['last'] = item[0]
+
+        if self.store is not None:
+            self.store.put(item + (entry['traceback'] if entry else None,))
+
+    def problems(self, fingerprint=None, limit=None):
+        """
+
+        :param fingerprint: optional filter
+        :param limit: optional max number of problems, the most recent
+        :return: list of dict, the most recent first
+        """
+        buffer = list(self._buffer)  # copy is atomic, the buffer may change while iterating
+        items = [dict(zip(self.fields, i)) for i in reversed(buffer)]
+        if fingerprint is not None:
+            items = [i for i in items if i['fingerprint'] == fingerprint]
+        return items[:limit] if limit else items
+
+    def fingerprints(self):
+        """
+
+        :return: list of dict with count, first and last time and traceback, the most frequent first
+        """
+        return sorted((dict(e) for e in list(self._index.values())), key=lambda e: e['count'], reverse=True)
+
+    def clear(self):
+        self._buffer.clear()
+        self._index.clear()
+
+
+class ProblemStore(ErrorLogQueue):
+    def __init__(self, path, maxsize=10000, batch_size=100):
+        """
+        Persists recorded problems to a SQLite file from a background thread
+
+        :param path: SQLite database path
+        :param maxsize: max number of problems in queue
+        :param batch_size: max number of problems written in a transaction
+        """
+        super().__init__(None, maxsize, batch_size)
+        self.path = path
+
+    def write(self, batch):
+        """
+
+        :param batch: list of tuples: time, code, type, path, fingerprint, traceback
+        """
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS problems "
+                    "(time REAL, code INTEGER, type TEXT, path TEXT, fingerprint TEXT, traceback TEXT)"
+                )
+                conn.executemany("INSERT INTO problems VALUES (?, ?, ?, ?, ?, ?)", batch)
+        finally:
+            conn.close()
+
+        self.written += len(batch)
+        self.batches += 1
+
+
+def recorder_blueprint(url_prefix, name='errors_handler_recorder'):
+    """
+    Blueprint that exposes recorded problems as json,
+    with query args: fingerprint and limit
+
+    :param url_prefix: url of endpoint
+    :param name: blueprint name
+    :return: Blueprint instance
+    """
+    bp = Blueprint(name, __name__, url_prefix=url_prefix)
+
+    @bp.route('')
+    def problems():
+        recorder = cap.extensions['errors_handler'].recorder
+        if recorder is None:
+            return dict(problems=[], fingerprints=[])
+
+        return dict(
+            problems=recorder.problems(request.args.get('fingerprint'), request.args.get('limit', type=int)),
+            fingerprints=recorder.fingerprints()
+        )
+
+    return bp
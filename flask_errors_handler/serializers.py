@@ -0,0 +1,163 @@
+import json
+import re
+from collections.abc import Mapping
+from itertools import islice
+from xml.sax.saxutils import escape
+
+import flask
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def flask_json(data):
+    """
+
+    :param data: problem dict
+    :return: json string encoded with flask app encoder
+    """
+    return flask.json.dumps(data)
+
+
+def compact_json(data):
+    """
+
+    :param data: problem dict
+    :return: json bytes without whitespaces
+    """
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def orjson_json(data):
+    """
+
+    :param data: problem dict
+    :return: json bytes encoded with orjson
+    """
+    if orjson is None:  # pragma: no cover
+        raise RuntimeError("you must install 'orjson' in order to use it as json encoder")
+    return orjson.dumps(data)
+
+
+def fallback_json(data):
+    """
+    Used when the configured encoder fails, i.e. with non serializable response payloads
+
+    :param data: problem dict
+    :return: json string, unknown objects are converted to string
+    """
+    try:
+        return flask.json.dumps(data)
+    except (TypeError, ValueError):
+        return json.dumps(data, default=str)
+
+
+def problem_json(data, encoder, batch_size=100):
+    """
+    Streaming json encoder of problem with errors member: the other members are encoded at once,
+    errors items in batches, so they can come from a generator and only a batch is in memory
+
+    :param data: problem dict
+    :param encoder: function that encodes a dict into json
+    :param batch_size: number of errors items encoded at once
+    """
+    def text(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def encode(batch):
+        # items are encoded as a json array, brackets are stripped
+        return text(encoder(dict(i=batch))).rstrip()[:-1].split('[', 1)[1].rstrip()[:-1]
+
+    data = dict(data)
+    errors = iter(data.pop('errors', None) or ())
+    head = text(encoder(data)).rstrip()[:-1]
+    yield ''.join((head, ',' if data else '', '"errors":['))
+
+    separator = ''
+    while True:
+        batch = list(islice(errors, batch_size))
+        if not batch:
+            break
+        yield separator + encode(batch)
+        separator = ','
+
+    yield ']}'
+
+
+XML_NAMESPACE = 'urn:ietf:rfc:7807'
+XML_INVALID_NAME_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def xml_name(name):
+    """
+
+    :param name: dict key
+    :return: valid xml element name
+    """
+    name = XML_INVALID_NAME_CHARS.sub('_', str(name))
+    if not name or not (name[0].isalpha() or name[0] == '_') or name.lower().startswith('xml'):
+        name = '_' + name
+    return name
+
+
+def xml_element(name, value):
+    """
+    Yields the xml of value as described in RFC 7807 appendix A:
+    arrays items are 'i' elements and null values are omitted
+
+    :param name: element name
+    :param value: json like object
+    """
+    if value is None:
+        return
+
+    name = xml_name(name)
+    if isinstance(value, Mapping):
+        yield '<{}>'.format(name)
+        for k, v in value.items():
+            yield from xml_element(k, v)
+        yield '</{}>'.format(name)
+    elif isinstance(value, (list, tuple, set, frozenset)) or hasattr(value, '__next__'):
+        yield '<{}>'.format(name)
+        for v in value:
+            yield from xml_element('i', v)
+        yield '</{}>'.format(name)
+    elif isinstance(value, bool):
+        yield '<{0}>{1}</{0}>'.format(name, 'true' if value else 'false')
+    else:
+        yield '<{0}>{1}</{0}>'.format(name, escape(str(value)))
+
+
+def problem_xml(data, chunk_size=8192):
+    """
+    Streaming xml encoder of problem, no DOM is built
+
+    :param data: problem dict
+    :param chunk_size: min size of yielded chunks
+    """
+    buffer, size = ['<?xml version="1.0" encoding="UTF-8"?>\n<problem xmlns="{}">'.format(XML_NAMESPACE)], 0
+    for k, v in data.items():
+        for item in xml_element(k, v):
+            buffer.append(item)
+            size += len(item)
+            if size >= chunk_size:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+
+    buffer.append('</problem>')
+    yield ''.join(buffer)
+
+
+MEDIA_TYPES = {
+    'json': ('application/{ct_id}+json', 'application/json'),
+    'xml':  ('application/{ct_id}+xml', 'application/xml', 'text/xml'),
+    'html': ('text/html', 'application/xhtml+xml'),
+}
+
+JSON_ENCODERS = {
+    'flask':   flask_json,
+    'compact': compact_json,
+    'orjson':  orjson_json,
+}
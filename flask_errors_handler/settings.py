@@ -0,0 +1,80 @@
+import weakref
+from collections import namedtuple
+
+from flask import current_app as cap
+
+_Settings = namedtuple('Settings', (
+    'default_msg',
+    'traceback_limit',
+    'force_content_type',
+    'content_types',
+    'xhr_enabled',
+    'page',
+))
+
+
+class Settings(_Settings):
+    """
+        Immutable snapshot of configuration read while handling errors
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+
+        :param config: Flask config
+        :return: Settings instance
+        """
+        return cls(
+            default_msg=config['ERROR_DEFAULT_MSG'],
+            traceback_limit=config['ERROR_TRACEBACK_LIMIT'],
+            force_content_type=config['ERROR_FORCE_CONTENT_TYPE'] is True,
+            content_types=tuple(config['ERROR_CONTENT_TYPES']),
+            xhr_enabled=config['ERROR_XHR_ENABLED'] is True,
+            page=config['ERROR_PAGE'],
+        )
+
+
+class AppStates:
+    def __init__(self):
+        """
+        State of an extension for each Flask app it is initialized with.
+        The app of current context is looked up only if more apps are initialized,
+        otherwise, or outside of an app context, the last state set is returned
+        """
+        self._states = weakref.WeakKeyDictionary()
+        self._last = None
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, app):
+        """
+
+        :param app: Flask instance
+        :return: state of app or None
+        """
+        return self._states.get(app)
+
+    def set(self, app, state):
+        """
+
+        :param app: Flask instance
+        :param state: state object
+        """
+        self._states[app] = state
+        self._last = state
+
+    def current(self):
+        """
+
+        :return: state of current app
+        """
+        if len(self._states) > 1:
+            try:
+                return self._states[cap._get_current_object()]
+            except (KeyError, RuntimeError):
+                pass
+        return self._last
@@ -0,0 +1,189 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import click
+from flask import current_app as cap
+from flask.cli import with_appcontext
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+MAGIC = b'FEHCNT01'
+HEADER = struct.Struct('8sQQ')  # magic, number of slots, increments dropped because the table is full
+SLOT = struct.Struct('24sQ')  # key, count
+EMPTY_KEY = b'\0' * 24
+
+
+class SharedCounters:
+    def __init__(self, path, slots=4096, stripes=16, max_probes=32):
+        """
+        Counters stored in a memory mapped file shared by processes, i.e. prefork workers.
+        Keys are kept in a fixed size open addressing table, slots are updated under striped locks:
+        a thread lock and a fcntl lock on a byte of the file for each stripe
+
+        :param path: file path, created if not exists, otherwise its number of slots is used
+        :param slots: max number of keys
+        :param stripes: number of locks
+        :param max_probes: max number of slots visited for a key before the increment is dropped
+        """
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError("shared counters require fcntl, they are supported only on unix")
+
+        self.path = path
+        self.stripes = stripes
+        self.max_probes = max_probes
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < HEADER.size:
+                os.ftruncate(self._fd, HEADER.size + slots * SLOT.size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, slots, 0), 0)
+            else:
+                magic, slots, _ = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+                if magic != MAGIC:
+                    raise ValueError("'{}' is not a counters file".format(path))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+        self.slots = slots
+        self._mm = mmap.mmap(self._fd, HEADER.size + slots * SLOT.size)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def _stripe(self, stripe):
+        """
+
+        :param stripe: index of lock
+        """
+        with self._locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+
+    def increment(self, key, value=1):
+        """
+        Occupied slots of other keys are skipped without locks, keys are never removed once written.
+        A read may see a key half written by another process: its bytes are zero or the ones of the key
+        being written, so slots whose bytes could belong to key are checked again under the lock
+
+        :param key: string of max 24 bytes once encoded
+        :param value: increment
+        :return: False if the key is not present and no empty slot is found within max_probes
+        """
+        key = key.encode()[:SLOT.size - 8].ljust(SLOT.size - 8, b'\0')
+        start = zlib.crc32(key)  # stable across processes, unlike hash()
+
+        for probe in range(min(self.max_probes, self.slots)):
+            index = (start + probe) % self.slots
+            offset = HEADER.size + index * SLOT.size
+            current = self._mm[offset:offset + SLOT.size - 8]
+            if current != key and any(c and c != k for c, k in zip(current, key)):
+                continue  # certainly another key
+
+            with self._stripe(index % self.stripes):
+                current, count = SLOT.unpack_from(self._mm, offset)
+                if current == key or current == EMPTY_KEY:
+                    SLOT.pack_into(self._mm, offset, key, count + value)
+                    return True
+
+        with self._stripe(0):
+            magic, slots, dropped = HEADER.unpack_from(self._mm, 0)
+            HEADER.pack_into(self._mm, 0, magic, slots, dropped + value)
+        return False
+
+    def count(self, code, fingerprint=None):
+        """
+
+        :param code: http status code
+        :param fingerprint: optional fingerprint of exception
+        """
+        self.increment("code:{}".format(code))
+        if fingerprint is not None:
+            self.increment("fp:{}".format(fingerprint))
+
+    def items(self):
+        """
+        Reads all counters without locks
+
+        :return: list of tuple: key, count
+        """
+        items = []
+        for index in range(self.slots):
+            key, count = SLOT.unpack_from(self._mm, HEADER.size + index * SLOT.size)
+            if key != EMPTY_KEY:
+                items.append((key.rstrip(b'\0').decode(), count))
+        return items
+
+    def snapshot(self):
+        """
+
+        :return: dict with counters by status code, by fingerprint and increments dropped
+        """
+        codes, fingerprints = {}, {}
+        for key, count in self.items():
+            kind, _, name = key.partition(':')
+            # a key may be in more slots if it was claimed concurrently by different processes
+            if kind == 'code':
+                codes[int(name)] = codes.get(int(name), 0) + count
+            elif kind == 'fp':
+                fingerprints[name] = fingerprints.get(name, 0) + count
+
+        return dict(codes=codes, fingerprints=fingerprints, dropped=HEADER.unpack_from(self._mm, 0)[2])
+
+
+def format_snapshot(snapshot, top=20):
+    """
+
+    :param snapshot: result of SharedCounters.snapshot
+    :param top: max number of fingerprints
+    :return: text table
+    """
+    lines = ["{:<20} {:>12}".format('status code', 'count')]
+    for code, count in sorted(snapshot['codes'].items()):
+        lines.append("{:<20} {:>12,}".format(code, count))
+
+    lines.append('')
+    lines.append("{:<20} {:>12}".format('fingerprint', 'count'))
+    fingerprints = sorted(snapshot['fingerprints'].items(), key=lambda i: i[1], reverse=True)
+    for fingerprint, count in fingerprints[:top]:
+        lines.append("{:<20} {:>12,}".format(fingerprint, count))
+
+    if snapshot['dropped']:
+        lines.append('')
+        lines.append("dropped: {:,} (table is full)".format(snapshot['dropped']))
+    return '\n'.join(lines)
+
+
+@click.command('errors-counters')
+@click.option('--watch', type=float, default=0, help='refresh interval in seconds, until interrupted')
+@click.option('--top', type=int, default=20, help='max number of fingerprints')
+@with_appcontext
+def counters_command(watch, top):
+    """
+    Prints errors counters shared by all workers
+    """
+    counters = cap.extensions['errors_handler'].counters
+    if counters is None:
+        raise click.ClickException("shared counters are disabled, set ERROR_SHARED_COUNTERS")
+
+    while True:
+        if watch:
+            click.clear()
+        click.echo(format_snapshot(counters.snapshot(), top))
+        if not watch:
+            return
+        time.sleep(watch)
@@ -0,0 +1,32 @@
+from flask.signals import Namespace
+
+_signals = Namespace()
+
+# sent with the Flask app as sender and the number of server errors in window as rate
+error_storm_started = _signals.signal('error-storm-started')
+error_storm_ended = _signals.signal('error-storm-ended')
+
+# sent with the Flask app as sender around every stage of error handling: normalize, dispatch, prepare,
+# serialize and render, with stage name, kind of handler, problem (None before normalize) and elapsed seconds
+stage_started = _signals.signal('error-stage-started')
+stage_finished = _signals.signal('error-stage-finished')
+
+
+def connected(*signals):
+    """
+
+    :param signals: blinker signals
+    :return: True if any signal has receivers
+    """
+    return any(getattr(s, 'receivers', None) for s in signals)
+
+
+def send(signal, sender, **kwargs):
+    """
+    Sends the signal only if it has receivers, so it costs nothing when unused
+
+    :param signal: blinker signal
+    :param sender: Flask app
+    """
+    if connected(signal):
+        signal.send(sender, **kwargs)
@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import deque
+
+
+class StormDetector:
+    def __init__(self, threshold, window, recovery=None, callback=None):
+        """
+        Detects when server errors are more than threshold in a sliding window of seconds,
+        the storm ends when they fall to recovery
+
+        :param threshold: number of errors in window that starts the storm
+        :param window: seconds
+        :param recovery: number of errors in window that ends the storm, default half of threshold
+        :param callback: function called with active flag and rate on every transition
+        """
+        self.threshold = threshold
+        self.window = window
+        self.recovery = threshold // 2 if recovery is None else recovery
+        self.callback = callback
+        self.active = False
+        self._hits = deque(maxlen=threshold)  # older hits are useless to detect the storm
+        self._lock = threading.Lock()
+
+    def _update(self, now):
+        """
+
+        :param now: monotonic time
+        :return: number of errors in window and True if state changed
+        """
+        start = now - self.window
+        hits = self._hits
+        while hits and hits[0] <= start:
+            hits.popleft()
+
+        rate = len(hits)
+        if not self.active and rate >= self.threshold:
+            self.active = True
+            return rate, True
+        if self.active and rate <= self.recovery:
+            self.active = False
+            return rate, True
+        return rate, False
+
+    def _notify(self, rate, changed):
+        if changed and self.callback is not None:
+            self.callback(self.active, rate)
+
+    def hit(self, now=None):
+        """
+        Records a server error
+
+        :param now: optional monotonic time
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._hits.append(now)
+            rate, changed = self._update(now)
+        self._notify(rate, changed)
+
+    def check(self, now=None):
+        """
+        Ends the storm if errors fell under recovery, it costs nothing outside a storm
+
+        :param now: optional monotonic time
+        :return: True if storm is active
+        """
+        if not self.active:
+            return False
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            rate, changed = self._update(now)
+        self._notify(rate, changed)
+        return self.active
@@ -55,6 +55,9 @@ setup(
     install_requires=[
         'Flask >= 1.0.4',
     ],
+    extras_require={
+        'orjson': ['orjson'],
+    },
     tests_require=[
         'pytest >= 5',
         'pytest-cov >= 2'
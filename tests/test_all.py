@@ -1,18 +1,34 @@
+import json
+import multiprocessing
+import sqlite3
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from werkzeug.routing import RequestRedirect
-from flask import Flask, abort, Response, Blueprint
+from flask import Flask, abort, Response, Blueprint, request as flask_request
 from werkzeug.datastructures import WWWAuthenticate
+from werkzeug.exceptions import HTTPException, NotFound
 from datetime import datetime
+from xml.etree import ElementTree
 from flask_errors_handler import (
-    ErrorHandler, SubdomainDispatcher, URLPrefixDispatcher
+    ApiProblem, BaseNormalize, DefaultNormalizer, ErrorDispatcher, ErrorHandler,
+    SubdomainDispatcher, URLPrefixDispatcher
 )
+from flask_errors_handler import signals
+from flask_errors_handler.cache import LRUCache
+from flask_errors_handler.logs import ExceptionDump
+from flask_errors_handler.metrics import NULL_TRACE, trace
+from flask_errors_handler.shared import HEADER, SLOT, SharedCounters
 
 error = ErrorHandler()
 
 
-@pytest.fixture
-def app():
+@pytest.fixture(params=[False, True], ids=['codes', 'bulk'])
+def app(request):
     _app = Flask(__name__)
+    _app.config['ERROR_REGISTER_BULK'] = request.param
+    _app.config['ERROR_XML_ENABLED'] = True
     _app.config['ERROR_PAGE'] = 'error.html'
     _app.config['SERVER_NAME'] = 'flask.dev:5000'
 
@@ -83,6 +99,7 @@ def app():
     @web.route('/web/error')
     def web_error():
         _app.config['ERROR_PAGE'] = None
+        error.reload_settings(_app)
         abort(500, 'Error from web blueprint')
 
     @custom.route('/custom')
@@ -242,3 +259,983 @@ def test_range(client):
     data = res.get_json()['response']
     assert data['length'] == 10
     assert data['units'] == 'bytes'
+
+
+def test_templates_compiled_once(client, monkeypatch):
+    assert ApiProblem.default_html_template in error._states.get(client.application).templates
+
+    def render_template_string(*args, **kwargs):  # pragma: no cover
+        raise AssertionError('template must not be compiled at runtime')
+
+    monkeypatch.setattr('flask.render_template_string', render_template_string)
+    res = client.get('/web/web/error')
+    assert res.status_code == 500
+    assert b'https://httpstatuses.com/500' in res.data
+
+
+def test_dispatch_longest_prefix():
+    _app = Flask(__name__)
+    handler = ErrorHandler()
+    handler.init_app(_app, dispatcher=URLPrefixDispatcher)
+
+    parent = Blueprint('parent', __name__, url_prefix='/prefix')
+    child = Blueprint('child', __name__, url_prefix='/child')
+    other = Blueprint('other', __name__, url_prefix='/prefixed')
+
+    for bp in (parent, child, other):
+        handler.register(bp)(lambda exc, name=bp.name: (name, exc.code))
+
+    parent.register_blueprint(child)
+    _app.register_blueprint(other)
+    _app.register_blueprint(parent)
+    client = _app.test_client()
+
+    assert client.get('/prefix/child/not-found').data == b'child'
+    assert client.get('/prefix/not-found').data == b'parent'
+    assert client.get('/prefixed/not-found').data == b'other'
+
+    res = client.get('/prefixchild/not-found')
+    assert res.status_code == 404
+    assert 'text/html' in res.headers['Content-Type']
+
+
+def test_dispatch_subdomain_pattern():
+    _app = Flask(__name__)
+    _app.config['SERVER_NAME'] = 'flask.dev:5000'
+    handler = ErrorHandler()
+    handler.init_app(_app, dispatcher=SubdomainDispatcher)
+
+    tenant = Blueprint('tenant', __name__, subdomain='<tenant>.api')
+    admin = Blueprint('admin', __name__, subdomain='admin.api')
+
+    for bp in (tenant, admin):
+        handler.register(bp)(lambda exc, name=bp.name: (name, exc.code))
+
+    _app.register_blueprint(tenant)
+    _app.register_blueprint(admin)
+    client = _app.test_client()
+
+    for name in ('acme', 'globex', 'acme'):
+        res = client.get('/not-found', base_url=f"http://{name}.api.flask.dev:5000")
+        assert res.data == b'tenant'
+
+    res = client.get('/not-found', base_url='http://admin.api.flask.dev:5000')
+    assert res.data == b'admin'
+
+
+def test_dispatcher_handlers_cache():
+    _app = Flask(__name__)
+    bp = Blueprint('bp', __name__, url_prefix='/bp')
+
+    def first(exc):  # pragma: no cover
+        return 'first', 404
+
+    def second(exc):  # pragma: no cover
+        return 'second', 404
+
+    ErrorHandler.register(bp, code=404)(first)
+    _app.register_blueprint(bp)
+    dispatcher = URLPrefixDispatcher()
+
+    with _app.test_request_context('/bp/not-found'):
+        exc = ApiProblem()
+        exc.code = 404
+        dispatcher.ensure_fresh()
+        assert dispatcher.get_handler('bp', exc) is first
+
+        _app.error_handler_spec['bp'][404] = {NotFound: second}
+        dispatcher.ensure_fresh()
+        assert dispatcher.get_handler('bp', exc) is first
+
+        ErrorDispatcher.invalidate()
+        dispatcher.ensure_fresh()
+        assert dispatcher.get_handler('bp', exc) is second
+
+
+def test_normalizer_registry(app):
+    class Teapot(HTTPException):
+        code = 418
+
+    class CustomMixin(BaseNormalize):
+        def normalize(self, ex, **kwargs):
+            if isinstance(ex, Teapot):
+                ex.headers = {'X-Mixin': 'mixin'}
+            return super().normalize(ex)
+
+    class Normalizer(DefaultNormalizer, CustomMixin):
+        pass
+
+    @Normalizer.register(Teapot)
+    def teapot(ex):
+        ex.response = dict(tea=True)
+
+    assert Normalizer.resolve(Teapot) is teapot
+    assert DefaultNormalizer.resolve(Teapot) is None
+
+    with app.app_context():
+        ex = Normalizer().normalize(Teapot(), ApiProblem)
+        assert ex.code == 418
+        assert ex.response == dict(tea=True)
+        assert ex.headers['X-Mixin'] == 'mixin'
+
+
+def test_response_cache():
+    _app = Flask(__name__)
+    _app.config['ERROR_RESPONSE_CACHE'] = 10
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='api')
+
+    @_app.route('/allowed', methods=['GET'])
+    def allowed():  # pragma: no cover
+        return 'allowed'
+
+    @_app.route('/custom')
+    def custom():
+        raise ApiProblem('custom', response=dict(request='data'))
+
+    client = _app.test_client()
+    responses = [client.get('/not-found') for _ in range(3)]
+    assert all(r.data == responses[0].data for r in responses)
+    assert responses[-1].status_code == 404
+    assert responses[-1].headers['Content-Type'] == 'application/problem+json'
+    assert handler.response_cache_stats() == dict(hits=2, misses=1, size=1, maxsize=10)
+
+    res = client.post('/allowed')
+    assert res.status_code == 405
+    assert 'GET' in res.headers['Allow']
+    assert handler.response_cache_stats()['size'] == 2
+
+    client.get('/custom')
+    assert handler.response_cache_stats()['size'] == 2
+
+
+def test_response_cache_custom_serialization():
+    class RequestProblem(ApiProblem):
+        def get_instance(self):
+            return flask_request.path
+
+    assert RequestProblem.custom_serialization and not ApiProblem.custom_serialization
+
+    _app = Flask(__name__)
+    _app.config['ERROR_RESPONSE_CACHE'] = 10
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='api', exc_class=RequestProblem)
+
+    client = _app.test_client()
+    assert client.get('/x').get_json()['instance'] == '/x'
+    assert client.get('/y').get_json()['instance'] == '/y'
+    assert handler.response_cache_stats()['size'] == 0
+
+    _app = Flask(__name__)
+    _app.config['ERROR_RESPONSE_CACHE'] = 10
+    handler = ErrorHandler()
+
+    def response(f):
+        def wrapper():
+            r, s, h = f()
+            r['path'] = flask_request.path
+            return Response(json.dumps(r), status=s, headers=h)
+        return wrapper
+
+    handler.init_app(_app, handler='api', response=response)
+    client = _app.test_client()
+    assert json.loads(client.get('/x').data)['path'] == '/x'
+    assert json.loads(client.get('/y').data)['path'] == '/y'
+    res = client.get('/x', headers={'Accept': 'application/xml'})
+    assert 'xml' not in res.headers['Content-Type']
+    assert json.loads(res.data)['path'] == '/x'
+    assert handler.response_cache_stats()['size'] == 0
+
+
+@pytest.mark.parametrize('encoder', ['flask', 'compact', 'orjson'])
+def test_json_encoder(encoder):
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
+
+    _app = Flask(__name__)
+    _app.config['ERROR_JSON_ENCODER'] = encoder
+    ErrorHandler().init_app(_app, handler='api')
+
+    @_app.route('/payload')
+    def payload():
+        raise ApiProblem('payload', response=dict(items=[1, 2], date=datetime(2000, 3, 1), obj=object()))
+
+    res = _app.test_client().get('/payload')
+    assert res.status_code == 500
+    assert res.headers['Content-Type'] == 'application/problem+json'
+    data = res.get_json()
+    assert data['response']['items'] == [1, 2]
+    assert data['response']['obj'].startswith('<object')
+
+
+def test_exception_dump(client, app, caplog):
+    app.config['ERROR_TRACEBACK_LIMIT'] = 1
+    app.extensions['errors_handler'].reload_settings(app)
+    res = client.get('/api/error')
+    assert res.status_code == 500
+
+    record, = [r for r in caplog.records if hasattr(r, 'exception_dump')]
+    dump = record.exception_dump.as_dict()
+    assert dump['exception']['type'] == 'NameError'
+    assert dump['exception']['message'] == 'exception from app'
+    assert len(dump['exception']['frames']) == 1
+    assert dump['exception']['frames'][0]['name'] == 'api_error'
+    assert "raise NameError('exception from app')" in record.getMessage()
+
+
+def test_log_sampling(caplog):
+    _app = Flask(__name__)
+    _app.config['ERROR_LOG_SAMPLING_WINDOW'] = 60
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='api', normalizer=DefaultNormalizer())
+
+    @_app.route('/error')
+    def app_error():
+        raise NameError('exception from app')
+
+    client = _app.test_client()
+    for _ in range(3):
+        assert client.get('/error').status_code == 500
+
+    full = [r for r in caplog.records if hasattr(r, 'exception_dump')]
+    assert len(full) == 1
+
+    sampler = handler._normalizer._sampler
+    fingerprint = full[0].exception_dump.fingerprint
+    sampler._seen[fingerprint][0] -= 60
+    caplog.clear()
+
+    client.get('/error')
+    record, = caplog.records
+    assert record.getMessage() == f"NameError: 2 more in last 60s (fingerprint: {fingerprint})"
+
+    @_app.route('/other')
+    def other_error():
+        raise KeyError('other exception')
+
+    client.get('/error')
+    sampler._seen[fingerprint][0] -= 60
+    caplog.clear()
+
+    client.get('/other')
+    summary, full = caplog.records
+    assert summary.getMessage() == f"NameError: 2 more in last 60s (fingerprint: {fingerprint})"
+    assert full.exception_dump.fingerprint != fingerprint
+    assert fingerprint not in sampler._seen
+
+
+def test_log_queue(tmp_path):
+    _app = Flask(__name__)
+    _app.config['ERROR_LOG_QUEUE'] = True
+    _app.config['ERROR_LOG_FILE'] = str(tmp_path / 'errors.log')
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='api', normalizer=DefaultNormalizer())
+
+    @_app.route('/error')
+    def app_error():
+        raise NameError('exception from app')
+
+    client = _app.test_client()
+    for _ in range(3):
+        assert client.get('/error').status_code == 500
+
+    log_queue = handler._normalizer.log_queue
+    log_queue.stop()
+    assert log_queue.stats()['written'] == 3
+    assert log_queue.stats()['dropped'] == 0
+
+    with open(tmp_path / 'errors.log') as f:
+        events = [json.loads(line) for line in f]
+
+    assert len(events) == 3
+    assert events[0]['code'] == 500
+    assert events[0]['path'] == '/error'
+    assert events[0]['fingerprint'] == events[2]['fingerprint']
+    assert "NameError: exception from app" in events[0]['traceback']
+
+
+def test_log_queue_releases_frames():
+    class Local:
+        pass
+
+    def fail(local):
+        raise NameError('exception from app')
+
+    local = Local()
+    ref = weakref.ref(local)
+    try:
+        fail(local)
+    except NameError as exc:
+        dump = ExceptionDump(exc).detach()
+    del local
+
+    assert ref() is None
+    assert dump.exc is None
+    assert "raise NameError('exception from app')" in str(dump)
+    assert dump.frames[-1]['name'] == 'fail'
+
+
+def test_concurrent_problem_headers():
+    _app = Flask(__name__)
+    ErrorHandler().init_app(_app, handler='api')
+
+    @_app.route('/problem/<int:n>')
+    def problem(n):
+        raise ApiProblem('problem', headers={f"X-Problem-{n % 10}": str(n)})
+
+    def get(n):
+        return n, _app.test_client().get(f"/problem/{n}").headers
+
+    with ThreadPoolExecutor(16) as pool:
+        for n, headers in pool.map(get, range(1000)):
+            assert [(k, v) for k, v in headers if k.startswith('X-Problem')] == [(f"X-Problem-{n % 10}", str(n))]
+
+    assert len(ApiProblem.headers) == 0
+
+
+def test_problem_headers_merged():
+    class Problem(ApiProblem):
+        headers = {'X-Class': 'c'}
+
+    problem = Problem(headers={'X-Inst': 'i'})
+    assert problem.headers == {'X-Class': 'c', 'X-Inst': 'i'}
+    assert Problem.headers == {'X-Class': 'c'}
+
+    problem = Problem()
+    problem.headers['X-Inst'] = 'i'
+    problem.headers.update({'X-Other': 'o'})
+    ApiProblem().headers['X-Inst'] = 'i'
+    assert Problem.headers == {'X-Class': 'c'} and len(ApiProblem.headers) == 0
+
+
+def test_metrics():
+    _app = Flask(__name__)
+    _app.config['ERROR_METRICS'] = True
+    _app.config['ERROR_METRICS_ENDPOINT'] = '/metrics'
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='web')
+
+    api = Blueprint('api', __name__, url_prefix='/api')
+    handler.api_register(api)
+
+    @api.route('/error')
+    def api_error():
+        raise NameError('exception from app')
+
+    _app.register_blueprint(api)
+    client = _app.test_client()
+    client.get('/api/error')
+    client.get('/api/error')
+    client.get('/not-found')
+    client.get('/not-found', headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    data = handler.metrics.snapshot()
+    errors = {(e['code'], e['blueprint'], e['exception'], e['handler']): e['count'] for e in data['errors']}
+    assert errors == {
+        (500, 'api', 'NameError', 'api'): 2,
+        (404, '', 'NotFound', 'web'): 2,
+    }
+    assert data['stages']['normalize']['count'] == 5  # xhr request is normalized again by api handler
+    assert data['stages']['serialize']['count'] == 3
+    assert data['stages']['render']['count'] == 1
+
+    res = client.get('/metrics')
+    assert res.status_code == 200
+    assert 'flask_errors_total{code="500",blueprint="api",exception="NameError",handler="api"} 2' in res.data.decode()
+    assert 'flask_errors_stage_seconds_count{stage="normalize"} 5' in res.data.decode()
+
+
+def test_content_negotiation(client):
+    res = client.get('/api', headers={'Accept': 'application/problem+xml'})
+    assert res.status_code == 500
+    assert res.mimetype == 'application/problem+xml'
+    problem = ElementTree.fromstring(res.data)
+    assert problem.tag == '{urn:ietf:rfc:7807}problem'
+    assert problem.find('{urn:ietf:rfc:7807}status').text == '500'
+    assert 'Error from app' in problem.find('{urn:ietf:rfc:7807}detail').text
+
+    res = client.get('/api', headers={'Accept': 'application/json;q=0.5, text/xml;q=0.9'})
+    assert res.mimetype == 'application/problem+xml'
+
+    res = client.get('/api', headers={'Accept': 'text/html'})
+    assert res.headers['Content-Type'] == 'application/problem+json'
+
+    res = client.get('/web/web', headers={'Accept': 'application/json'})
+    assert res.headers['Content-Type'] == 'application/problem+json'
+    assert res.get_json()['status'] == 500
+
+    res = client.get('/web/web', headers={'Accept': 'text/html,application/xml;q=0.9,*/*;q=0.8'})
+    assert res.headers['Content-Type'] == 'text/html; charset=utf-8'
+    assert set(res.vary) == {'Accept', 'X-Requested-With'}
+
+    res = client.get('/api', headers={'Accept': '*/*'})
+    assert res.headers['Content-Type'] == 'application/problem+json'
+    assert 'Accept' in res.vary
+
+
+def test_content_negotiation_xml_disabled():
+    _app = Flask(__name__)
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='api')
+    client = _app.test_client()
+
+    res = client.get('/not-found', headers={'Accept': 'text/html,application/xml;q=0.9,*/*;q=0.8'})
+    assert res.headers['Content-Type'] == 'application/problem+json'
+    assert 'Accept' not in res.vary
+
+
+def test_register_bulk(app):
+    if app.config['ERROR_REGISTER_BULK']:
+        assert list(app.error_handler_spec['api']) == [None]
+        assert set(app.error_handler_spec['api'][None]) == {HTTPException, Exception}
+    else:
+        assert len(app.error_handler_spec['api']) > 1
+
+
+@pytest.mark.parametrize('bulk', [False, True], ids=['codes', 'bulk'])
+def test_register_bulk_dispatcher(bulk):
+    _app = Flask(__name__)
+    _app.config['ERROR_REGISTER_BULK'] = bulk
+    handler = ErrorHandler()
+    handler.init_app(_app, dispatcher='default')
+
+    bp = Blueprint('bp', __name__, url_prefix='/bp')
+    handler.api_register(bp)
+
+    @bp.route('/missing')
+    def missing():
+        abort(404)
+
+    @bp.route('/only-get')
+    def only_get():
+        abort(405, valid_methods=['GET'])
+
+    _app.register_blueprint(bp)
+    client = _app.test_client()
+
+    res = client.get('/bp/missing')
+    assert res.status_code == 404
+    assert res.headers['Content-Type'] == 'application/problem+json'
+
+    res = client.get('/bp/only-get')
+    assert res.status_code == 405
+    assert res.headers['Content-Type'] == 'application/problem+json'
+    assert res.headers['Allow'] == 'GET'
+
+    res = client.get('/not-found')
+    assert res.status_code == 404
+    assert 'text/html' in res.headers['Content-Type']
+
+
+@pytest.mark.parametrize('bulk', [False, True], ids=['codes', 'bulk'])
+def test_register_bulk_app_code_handler(bulk):
+    _app = Flask(__name__)
+    handler = ErrorHandler()
+    handler.init_app(_app)
+
+    @_app.errorhandler(404)
+    def app_not_found(exc):
+        return 'app handler', 404
+
+    bp = Blueprint('bp', __name__, url_prefix='/bp')
+    handler.api_register(bp, bulk=bulk)
+    if bulk:
+        handler.api_register(bp, code=404)
+
+    @bp.route('/missing')
+    def missing():
+        abort(404)
+
+    @bp.route('/gone')
+    def gone():
+        abort(410)
+
+    # app handler by code wins over blueprint handlers by class
+    other = Blueprint('other', __name__, url_prefix='/other')
+    handler.api_register(other, bulk=True)
+    other.route('/missing')(missing)
+
+    _app.register_blueprint(bp)
+    _app.register_blueprint(other)
+    client = _app.test_client()
+
+    res = client.get('/bp/missing')
+    assert res.headers['Content-Type'] == 'application/problem+json'
+    assert client.get('/bp/gone').headers['Content-Type'] == 'application/problem+json'
+    assert client.get('/not-found').data == b'app handler'
+    assert client.get('/other/missing').data == b'app handler'
+
+
+def test_reload_settings(client, app):
+    handler = app.extensions['errors_handler']
+    app.config['ERROR_DEFAULT_MSG'] = 'Changed'
+    assert client.get('/api/error').get_json()['detail'] == 'Unhandled Exception'
+
+    handler.reload_settings(app)
+    assert client.get('/api/error').get_json()['detail'] == 'Changed'
+
+    assert handler._rewrite_content_type('application/xml') == 'application/problem+xml'
+    assert handler._rewrite_content_type('text/html') == 'text/html'
+    assert handler._rewrite_content_type(None) == 'x-application/problem'
+    assert set(handler._states.get(app).content_types) >= {'application/xml', 'text/html', None}
+
+
+def test_debug_set_after_init_app():
+    _app = Flask(__name__)
+    ErrorHandler().init_app(_app, handler='api')
+
+    @_app.route('/error')
+    def app_error():
+        raise NameError('exception from app')
+
+    client = _app.test_client()
+    assert client.get('/error').get_json()['detail'] == 'Unhandled Exception'
+    _app.debug = True
+    assert 'NameError: exception from app' in client.get('/error').get_json()['detail']
+
+
+def test_multiple_apps():
+    handler = ErrorHandler()
+    apps = []
+    for name in ('one', 'two'):
+        _app = Flask(name)
+        _app.config['ERROR_DEFAULT_MSG'] = f"app {name}"
+        _app.config['ERROR_METRICS'] = True
+        _app.config['ERROR_RESPONSE_CACHE'] = 10
+        _app.config['ERROR_RECORDER_SIZE'] = 10 if name == 'one' else 0
+        handler.init_app(_app, handler='api')
+
+        @_app.route('/error')
+        def app_error():
+            raise NameError('exception from app')
+
+        apps.append(_app)
+
+    one, two = apps
+    assert one.test_client().get('/error').get_json()['detail'] == 'app one'
+    assert two.test_client().get('/error').get_json()['detail'] == 'app two'
+    assert one.test_client().get('/missing').status_code == 404
+
+    def errors():
+        return sum(e['count'] for e in handler.metrics.snapshot()['errors'])
+
+    with one.app_context():
+        assert errors() == 2
+        assert handler.response_cache_stats()['misses'] == 1
+        assert len(handler.recorder.problems()) == 2
+    with two.app_context():
+        assert errors() == 1
+        assert handler.response_cache_stats()['misses'] == 0
+        assert handler.recorder is None
+
+
+def test_error_storm(caplog):
+    _app = Flask(__name__)
+    _app.config['ERROR_STORM_THRESHOLD'] = 2
+    _app.config['ERROR_STORM_WINDOW'] = 60
+    _app.config['ERROR_STORM_RECOVERY'] = 0
+    _app.config['ERROR_XML_ENABLED'] = True
+    _app.config['ERROR_RECORDER_SIZE'] = 100
+    _app.config['ERROR_METRICS'] = True
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='web')
+
+    api = Blueprint('api', __name__, url_prefix='/api')
+    handler.api_register(api)
+
+    @_app.route('/error')
+    def app_error():
+        raise NameError('exception from app')
+
+    @api.route('/unavailable')
+    def unavailable():
+        abort(503, retry_after=30)
+
+    _app.register_blueprint(api)
+    transitions = []
+
+    def receiver(sender, rate):
+        transitions.append(rate)
+
+    signals.error_storm_started.connect(receiver, _app)
+    signals.error_storm_ended.connect(receiver, _app)
+
+    client = _app.test_client()
+    assert client.get('/error').status_code == 500
+    assert client.get('/error').status_code == 500
+    assert handler.storm.active is True
+    assert transitions == [2]
+
+    caplog.clear()
+    for accept in ('text/html', 'application/json'):
+        res = client.get('/error', headers={'Accept': accept})
+        assert res.status_code == 500
+        assert not [r for r in caplog.records if hasattr(r, 'exception_dump')]
+    assert res.get_json()['detail'] == 'Unhandled Exception'
+    assert client.get('/not-found').status_code == 404
+    assert len([r for r in caplog.records if 'NameError: exception from app' in r.getMessage()]) == 2
+
+    res = client.get('/api/unavailable', headers={'Accept': 'application/xml'})
+    assert res.status_code == 503
+    assert res.headers['Retry-After'] == '30'
+    assert res.headers['Content-Type'].startswith('application/problem+xml')
+    assert ElementTree.fromstring(res.data).find('{urn:ietf:rfc:7807}status').text == '503'
+
+    assert len(handler.recorder) == 6
+    assert sum(e['count'] for e in handler.metrics.snapshot()['errors']) == 6
+
+    with _app.app_context():
+        assert handler.storm.check(time.monotonic() + 61) is False
+    assert transitions == [2, 0]
+
+    signals.error_storm_started.disconnect(receiver, _app)
+    signals.error_storm_ended.disconnect(receiver, _app)
+
+
+def test_page_cache(monkeypatch):
+    _app = Flask(__name__)
+    _app.config['ERROR_PAGE_CACHE'] = 10
+    _app.config['ERROR_PAGE_CACHE_KEY'] = lambda: flask_request.args.get('lang')
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='web')
+    client = _app.test_client()
+
+    renders = []
+    monkeypatch.setattr('flask.templating._render', lambda t, c, a: renders.append(t) or t.render(c))
+
+    first = client.get('/not-found').data
+    assert client.get('/not-found').data == first
+    client.get('/not-found?lang=it')
+    assert len(renders) == 2
+    assert handler.page_cache_stats() == dict(hits=1, misses=2, size=2, maxsize=10)
+
+    _app.jinja_env.cache.clear()  # templates reloaded
+    assert client.get('/not-found').data == first
+    assert len(renders) == 3
+
+    cache = LRUCache(2, ttl=0.01)
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    time.sleep(0.02)
+    assert cache.get('key') is None
+
+
+def test_multi_problem():
+    _app = Flask(__name__)
+    _app.config['ERROR_XML_ENABLED'] = True
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='api')
+
+    @_app.route('/import')
+    def bulk_import():
+        errors = (dict(field=f"field{i}", message='invalid value') for i in range(1000))
+        raise ApiProblem('invalid payload', errors=errors)
+
+    client = _app.test_client()
+    res = client.get('/import')
+    assert res.status_code == 500
+    assert res.headers['Content-Type'] == 'application/problem+json'
+    assert 'Content-Length' not in res.headers
+    data = res.get_json()
+    assert data['detail'] == 'invalid payload'
+    assert len(data['errors']) == 1000
+    assert data['errors'][-1] == dict(field='field999', message='invalid value')
+
+    res = client.get('/import', headers={'Accept': 'application/xml'})
+    root = ElementTree.fromstring(res.data)
+    ns = {'p': 'urn:ietf:rfc:7807'}
+    assert len(root.findall('p:errors/p:i', ns)) == 1000
+    assert root.find('p:errors/p:i/p:field', ns).text == 'field0'
+
+    with _app.test_request_context():
+        problem, _, _ = ApiProblem().prepare_response()
+        assert 'errors' not in problem
+
+
+def test_multi_problem_not_cached():
+    _app = Flask(__name__)
+    _app.config['ERROR_RESPONSE_CACHE'] = 10
+    _app.config['ERROR_PAGE_CACHE'] = 10
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='web')
+
+    def problem(field):
+        exc = ApiProblem('invalid payload', errors=[dict(field=field)])
+        exc.cacheable = True
+        return exc
+
+    with _app.test_request_context():
+        assert handler._response_cache_key(problem('a'), 'application/problem+json') is None
+
+    for field in ('a', 'b'):
+        with _app.test_request_context(headers={'Accept': 'text/html'}):
+            handler.render_page(problem(field))
+    assert handler.page_cache_stats()['size'] == 0
+
+
+def test_recorder(tmp_path):
+    _app = Flask(__name__)
+    _app.config['ERROR_RECORDER_SIZE'] = 3
+    _app.config['ERROR_RECORDER_ENDPOINT'] = '/_errors'
+    _app.config['ERROR_RECORDER_SQLITE'] = str(tmp_path / 'errors.db')
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='web')
+
+    @_app.route('/error')
+    def app_error():
+        raise NameError('exception from app')
+
+    @_app.route('/problem')
+    def problem():
+        raise ApiProblem('problem from app')
+
+    client = _app.test_client()
+    client.get('/error')
+    client.get('/error')
+    client.get('/problem')
+    client.get('/not-found', headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    recorder = handler.recorder
+    assert len(recorder) == 3
+    problems = client.get('/_errors').get_json()['problems']
+    assert [(p['code'], p['path']) for p in problems] == [(404, '/not-found'), (500, '/problem'), (500, '/error')]
+
+    fingerprint, = recorder.fingerprints()
+    assert fingerprint['count'] == 2
+    assert "raise NameError('exception from app')" in fingerprint['traceback']
+    res = client.get('/_errors', query_string=dict(fingerprint=fingerprint['fingerprint']))
+    assert len(res.get_json()['problems']) == 1
+
+    recorder.store.stop()
+    with sqlite3.connect(_app.config['ERROR_RECORDER_SQLITE']) as conn:
+        rows = conn.execute("SELECT code, path, traceback IS NOT NULL FROM problems").fetchall()
+    assert rows == [(500, '/error', 1), (500, '/error', 1), (500, '/problem', 0), (404, '/not-found', 0)]
+
+
+def _increment_counters(path):
+    counters = SharedCounters(path)
+    for _ in range(200):
+        counters.count(500, 'abcdef0123456789')
+    counters.close()
+
+
+def test_shared_counters(tmp_path):
+    path = str(tmp_path / 'counters')
+    _app = Flask(__name__)
+    _app.config['ERROR_SHARED_COUNTERS'] = path
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='web')
+
+    @_app.route('/error')
+    def app_error():
+        raise NameError('exception from app')
+
+    client = _app.test_client()
+    client.get('/error')
+    client.get('/not-found', headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    snapshot = handler.counters.snapshot()
+    assert snapshot['codes'] == {500: 1, 404: 1}
+    assert list(snapshot['fingerprints'].values()) == [1]
+
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=_increment_counters, args=(path,)) for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    snapshot = handler.counters.snapshot()
+    assert snapshot['codes'][500] == 801
+    assert snapshot['fingerprints']['abcdef0123456789'] == 800
+
+    result = _app.test_cli_runner().invoke(args=['errors-counters'])
+    assert result.exit_code == 0
+    assert 'abcdef0123456789' in result.output
+
+    small = SharedCounters(str(tmp_path / 'small'), slots=2)
+    assert small.increment('a') and small.increment('b')
+    assert small.increment('c') is False
+    assert small.snapshot()['dropped'] == 1
+    small.close()
+
+    bounded = SharedCounters(str(tmp_path / 'bounded'), slots=1024, max_probes=1)
+    results = [bounded.increment(str(i)) for i in range(200)]
+    assert not all(results)
+    assert len(bounded.items()) == results.count(True)
+    assert bounded.increment(bounded.items()[0][0])
+    bounded.close()
+
+    # a key claimed in two slots by different processes
+    duplicated = SharedCounters(str(tmp_path / 'duplicated'), slots=8)
+    for index in range(2):
+        SLOT.pack_into(duplicated._mm, HEADER.size + index * SLOT.size, b'code:404'.ljust(24, b'\0'), 2)
+    assert duplicated.snapshot()['codes'] == {404: 4}
+    duplicated.close()
+
+
+def test_stage_signals(client, app):
+    events = []
+
+    def started(sender, stage, kind, problem, elapsed):
+        events.append(('started', stage, kind, problem is not None))
+
+    def finished(sender, stage, kind, problem, elapsed):
+        assert elapsed >= 0
+        events.append(('finished', stage, kind, problem is not None))
+
+    assert trace(None, 'api', NameError()) is NULL_TRACE
+
+    signals.stage_started.connect(started, app)
+    signals.stage_finished.connect(finished, app)
+    try:
+        client.get('/api/error')
+    finally:
+        signals.stage_started.disconnect(started)
+        signals.stage_finished.disconnect(finished)
+
+    assert events == [
+        ('started', 'normalize', 'api', False),
+        ('finished', 'normalize', 'api', True),
+        ('started', 'serialize', 'api', True),
+        ('started', 'prepare', 'api', True),
+        ('finished', 'prepare', 'api', True),
+        ('finished', 'serialize', 'api', True),
+    ]
+    assert trace(None, 'api', NameError()) is NULL_TRACE
+
+
+def test_cache_policies():
+    _app = Flask(__name__)
+    _app.config['ERROR_RESPONSE_CACHE'] = 10
+    _app.config['ERROR_CACHE_POLICIES'] = {404: 60, ('web', 410): 'public, max-age=3600, immutable'}
+    handler = ErrorHandler()
+    handler.init_app(_app, handler='api')
+
+    web = Blueprint('web', __name__, url_prefix='/web')
+    handler.web_register(web)
+
+    @web.route('/retired')
+    def retired():
+        abort(410)
+
+    @web.route('/missing')
+    def missing():
+        abort(404)
+
+    _app.register_blueprint(web)
+    client = _app.test_client()
+
+    res = client.get('/not-found')
+    assert res.status_code == 404
+    assert res.headers['Cache-Control'] == 'public, max-age=60'
+    assert res.headers['Vary'] == 'Accept'
+    etag = res.headers['ETag']
+
+    res = client.get('/not-found', headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.data == b''
+    assert res.headers['ETag'] == etag
+    assert res.headers['Cache-Control'] == 'public, max-age=60'
+
+    assert client.get('/not-found', headers={'If-None-Match': '"other"'}).status_code == 404
+    assert 'Cache-Control' not in client.post('/not-found').headers
+
+    res = client.get('/web/retired')
+    assert res.status_code == 410
+    assert res.headers['Cache-Control'] == 'public, max-age=3600, immutable'
+    assert client.get('/web/retired', headers={'If-None-Match': res.headers['ETag']}).status_code == 304
+    assert client.get('/web/missing').headers['Cache-Control'] == 'public, max-age=60'
+
+
+def test_cache_policies_etag_and_dispatcher():
+    _app = Flask(__name__)
+    _app.config['ERROR_CACHE_POLICIES'] = {('api', 404): 60, 409: 30}
+    handler = ErrorHandler()
+    handler.init_app(_app, dispatcher='urlprefix')
+
+    api = Blueprint('api', __name__, url_prefix='/api')
+    handler.api_register(api)
+
+    @api.route('/conflict')
+    def conflict():
+        exc = ApiProblem('conflict', headers={'ETag': '"v1"'})
+        exc.code = 409
+        raise exc
+
+    _app.register_blueprint(api)
+    client = _app.test_client()
+
+    res = client.get('/api/conflict')
+    assert res.status_code == 409
+    assert res.headers['ETag'] == '"v1"'
+    assert res.headers['Cache-Control'] == 'public, max-age=30'
+
+    res = client.get('/api/conflict', headers={'If-None-Match': '"v1"'})
+    assert res.status_code == 304
+    assert res.headers['Cache-Control'] == 'public, max-age=30'
+    assert res.headers['Vary'] == 'Accept'
+
+    res = client.get('/api/not-found')
+    assert res.status_code == 404
+    assert res.headers['Cache-Control'] == 'public, max-age=60'
+    assert 'Cache-Control' not in client.get('/not-found').headers
+
+
+def test_extension_members():
+    class OutOfCredit(ApiProblem):
+        extensions = ('balance', 'accounts')
+        type = 'https://example.com/probs/out-of-credit'
+        balance = 0
+
+    class Detailed(OutOfCredit):
+        extensions = ('reason',)
+
+        def get_detail(self):
+            return 'detail: ' + self.description
+
+    class Custom(OutOfCredit):
+        def to_dict(self):
+            return dict(balance=self.balance)
+
+    class Child(Custom):
+        pass
+
+    assert OutOfCredit.extension_members == ('balance', 'accounts')
+    assert Detailed.extension_members == ('balance', 'accounts', 'reason')
+
+    exc = OutOfCredit('no credit', balance=30, accounts=['/account/1'])
+    exc.code = 403
+    data, status, _ = exc.prepare_response()
+    assert status == 403
+    assert list(data) == ['type', 'instance', 'detail', 'title', 'status', 'response', 'balance', 'accounts']
+    assert data['type'] == 'https://example.com/probs/out-of-credit'
+    assert data['title'] == 'Forbidden'
+    assert data['balance'] == 30
+
+    data = Detailed('no credit', reason='expired').to_dict()
+    assert data['detail'] == 'detail: no credit'
+    assert data['reason'] == 'expired'
+    assert data['balance'] == 0
+    assert 'accounts' not in data
+
+    exc = ApiProblem(type='https://example.com/{code}')
+    exc.code = 404
+    assert exc.to_dict()['type'] == 'https://example.com/404'
+    assert ApiProblem().to_dict()['type'] == 'https://httpstatuses.com/500'
+
+    assert Custom(balance=1).to_dict() == dict(balance=1)
+    assert Child(balance=2).to_dict() == dict(balance=2)
+
+    for name in ('status', 'name', 'code', 'headers', 'get_type'):
+        with pytest.raises(ValueError):
+            type('Invalid', (ApiProblem,), dict(extensions=(name,)))
+
+    _app = Flask(__name__)
+    ErrorHandler().init_app(_app, handler='api')
+
+    @_app.route('/credit')
+    def credit():
+        raise OutOfCredit('no credit', balance=30)
+
+    assert _app.test_client().get('/credit').get_json()['balance'] == 30
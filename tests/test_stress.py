@@ -0,0 +1,166 @@
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+import pytest
+from flask import Flask, Blueprint, abort
+from werkzeug.serving import make_server
+
+from flask_errors_handler import ApiProblem, ErrorHandler
+
+REQUESTS = int(os.environ.get('STRESS_REQUESTS', 2000))
+THREADS = int(os.environ.get('STRESS_THREADS', 16))
+
+KINDS = ('problem', 'abort', 'retry', 'error', 'web', 'xml')
+
+
+def create_app(config):
+    _app = Flask(__name__)
+    _app.config['ERROR_XML_ENABLED'] = True
+    _app.config.update(config)
+    handler = ErrorHandler()
+    handler.init_app(_app, dispatcher='urlprefix')
+
+    api = Blueprint('api', __name__, url_prefix='/api')
+    web = Blueprint('web', __name__, url_prefix='/web')
+    handler.api_register(api)
+    handler.web_register(web)
+    handler.failure_register(_app)
+
+    @api.route('/problem/<int:n>')
+    def problem(n):
+        exc = ApiProblem(f"problem {n}", headers={'X-Request-Id': str(n)}, instance=f"/problems/{n}")
+        exc.code = 409
+        raise exc
+
+    @api.route('/abort/<int:n>')
+    def aborted(n):
+        abort(404, f"not found {n}")
+
+    @api.route('/retry/<int:n>')
+    def retry(n):
+        abort(429, retry_after=n)
+
+    @api.route('/error/<int:n>')
+    def error(n):
+        raise NameError(f"error {n}")
+
+    @web.route('/error/<int:n>')
+    def web_error(n):
+        abort(503, f"web {n}")
+
+    _app.register_blueprint(api)
+    _app.register_blueprint(web)
+    return _app
+
+
+@pytest.fixture(params=[
+    dict(),
+    dict(
+        ERROR_RESPONSE_CACHE=100, ERROR_PAGE_CACHE=100, ERROR_RECORDER_SIZE=100,
+        ERROR_METRICS=True, ERROR_LOG_SAMPLING_WINDOW=60
+    ),
+], ids=['default', 'caches'])
+def server(request):
+    _app = create_app(request.param)
+    _app.logger.disabled = True
+    srv = make_server('127.0.0.1', 0, _app, threaded=True)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    thread.join()
+
+
+def fetch(port, kind, n):
+    """
+
+    :param port: server port
+    :param kind: kind of error
+    :param n: request number
+    :return: status, headers, body and seconds elapsed
+    """
+    path, headers = {
+        'problem': (f"/api/problem/{n}", {}),
+        'abort':   (f"/api/abort/{n}", {}),
+        'retry':   (f"/api/retry/{n}", {}),
+        'error':   (f"/api/error/{n}", {}),
+        'web':     (f"/web/error/{n}", {'Accept': 'text/html'}),
+        'xml':     (f"/api/abort/{n}", {'Accept': 'application/xml'}),
+    }[kind]
+
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('GET', path, headers=headers)
+        res = conn.getresponse()
+        body = res.read()
+    finally:
+        conn.close()
+    return res.status, res.headers, body, time.perf_counter() - start
+
+
+def check(kind, n, status, headers, body):
+    """
+    Asserts that response matches what its request raised
+    """
+    if kind == 'problem':
+        assert status == 409
+        assert headers['X-Request-Id'] == str(n)
+        assert headers['Content-Type'] == 'application/problem+json'
+        data = json.loads(body)
+        assert data['detail'] == f"problem {n}"
+        assert data['instance'] == f"/problems/{n}"
+    elif kind == 'abort':
+        assert status == 404
+        assert headers['Content-Type'] == 'application/problem+json'
+        assert 'X-Request-Id' not in headers
+        assert f"not found {n}" in json.loads(body)['detail']
+    elif kind == 'retry':
+        assert status == 429
+        assert headers['Retry-After'] == str(n)
+        assert 'X-Request-Id' not in headers
+    elif kind == 'error':
+        assert status == 500
+        assert headers['Content-Type'] == 'application/problem+json'
+        assert json.loads(body)['detail'] == 'Unhandled Exception'
+    elif kind == 'web':
+        assert status == 503
+        assert headers['Content-Type'].startswith('text/html')
+        assert f"web {n}" in body.decode()
+    elif kind == 'xml':
+        assert status == 404
+        assert headers['Content-Type'].startswith('application/problem+xml')
+        root = ElementTree.fromstring(body)
+        assert f"not found {n}" in root.find('{urn:ietf:rfc:7807}detail').text
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def test_concurrent_mixed_errors(server, record_property):
+    port = server.server_port
+    rnd = random.Random(0)
+    jobs = [(rnd.choice(KINDS), n) for n in range(REQUESTS)]
+
+    def run(job):
+        kind, n = job
+        status, headers, body, elapsed = fetch(port, kind, n)
+        check(kind, n, status, headers, body)
+        return elapsed
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        latencies = list(pool.map(run, jobs))
+
+    p50, p99 = percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+    record_property('p50_ms', round(p50, 3))
+    record_property('p99_ms', round(p99, 3))
+
+    assert len(latencies) == REQUESTS